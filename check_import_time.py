@@ -0,0 +1,72 @@
+""" Remote Sensing  Predictables  - import-time check of download_s2_GEE
+
+#======================================================================================
+# Description
+#====================================================================================
+
+The heavy optional packages (geemap, folium, geopandas, rasterio, numpy, ...) must only be imported
+by the features that use them. This script imports download_s2_GEE in fresh interpreters and fails
+when the import takes more than 100 ms or when a heavy package is imported with the module.
+
+  python check_import_time.py [--max-ms 100] [--runs 5]
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_PACKAGES = ['geemap', 'folium', 'geopandas', 'rasterio', 'numpy', 'pandas', 'shapely', 'PIL', 'yaml', 'ee']
+
+# measured in a fresh interpreter, so that nothing is already in sys.modules
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import download_s2_GEE
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'modules': sorted(m.split('.')[0] for m in sys.modules)}))
+"""
+
+
+def import_time(runs=5):
+  """
+    Description:
+      import download_s2_GEE in runs fresh interpreters
+    Args:
+      @ runs : number of imports
+    Returns:
+      - the fastest import time (s) and the top level modules loaded by the import
+  """
+  folder = os.path.dirname(os.path.abspath(__file__))
+  times = []
+  modules = set()
+  for _ in range(runs):
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=folder, capture_output=True, text=True, check=True)
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    times.append(result['seconds'])
+    modules.update(result['modules'])
+  return min(times), modules
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='import-time check of download_s2_GEE')
+  parser.add_argument('--max-ms', type=float, default=100)
+  parser.add_argument('--runs', type=int, default=5)
+  args = parser.parse_args(argv)
+
+  seconds, modules = import_time(args.runs)
+  heavy = [name for name in HEAVY_PACKAGES if name in modules]
+  print('import download_s2_GEE', round(seconds * 1000, 1), 'ms')
+  if heavy:
+    print('heavy packages imported with the module :', heavy)
+  if seconds * 1000 > args.max_ms or heavy:
+    print('FAILED (limit', args.max_ms, 'ms)')
+    return 1
+  print('OK')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
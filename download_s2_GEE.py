@@ -5,7 +5,7 @@ Created on May 13, 2022
 #======================================================================================
 # Description
 #====================================================================================
-"""
+
 This file shows how to download sentinel-2 images on GEE. Some images that can be download are :
  RGB, MNDWI, NDWI, S2cloudless layer, and the mask cloud layer (both for RGB and MNDWI).
 
@@ -16,7 +16,11 @@ This file shows how to download sentinel-2 images on GEE. Some images that can b
 # =====================================================================================
 
 # import datetime packages
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
+import os
+
+# the heavy optional packages (geemap, geopandas, rasterio, numpy, ...) are only imported
+# in the methods that need them, to keep the import of the module fast
 
 
 # Login into GEE
@@ -35,10 +39,33 @@ class download_s2_images(object):
       download sentinel 2 data on Google earth engine based on some criteria
   """          
 
+  # registry of the products : source collection, required bands, band math, visualization and output dtype.
+  # band math : normalized_difference of the 2 bands, visualize (the export is the visualized image),
+  # select (raw bands) or an image.expression string using the band names.
+  # The order of the registry is the priority of call_task and call_viz_image
+  products = {
+    'rgb':   {'collection': 'COPERNICUS/S2_SR', 'bands': ['B4', 'B3', 'B2'], 'math': 'visualize',
+              'vis': {'min': 0.0, 'max': 3000, 'bands': ['B4', 'B3', 'B2']}, 'dtype': 'uint8'},
+    'mndwi': {'collection': 'COPERNICUS/S2_SR', 'bands': ['B3', 'B11'], 'math': 'normalized_difference',
+              'vis': {'min': 0, 'max': 0.8, 'palette': ['white', 'blue']}, 'dtype': 'float32'},
+    'ndvi':  {'collection': 'COPERNICUS/S2_SR', 'bands': ['B8', 'B4'], 'math': 'normalized_difference',
+              'vis': {'min': 0, 'max': 0.8, 'palette': ['white', 'green']}, 'dtype': 'float32'},
+    'swi':   {'collection': 'COPERNICUS/S2_SR', 'bands': ['B5', 'B11'], 'math': 'normalized_difference',
+              'vis': {'min': 0, 'max': 0.8, 'palette': ['white', 'blue']}, 'dtype': 'float32'},
+    'ndwi':  {'collection': 'COPERNICUS/S2_SR', 'bands': ['B8', 'B11'], 'math': 'normalized_difference',
+              'vis': {'min': 0, 'max': 0.8, 'palette': ['white', 'blue']}, 'dtype': 'float32'},
+    'cloud': {'collection': 'COPERNICUS/S2_CLOUD_PROBABILITY', 'bands': ['probability'], 'math': 'select',
+              'vis': {'min': 0, 'max': 100, 'palette': ['black', 'white']}, 'dtype': 'uint8'},
+  }
+
+  # cast (GEE) and size in bytes of the dtypes of the registry
+  dtypes = {'uint8': ('toUint8', 1), 'uint16': ('toUint16', 2), 'int16': ('toInt16', 2), 'int32': ('toInt32', 4),
+            'float32': ('toFloat', 4), 'float64': ('toDouble', 8)}
+
   #================================================================================================
   #
   #================================================================================================
-  def  __init__(self, api, boundaries_path, start_date,end_date, cloud_percentage,function='mosaic', folder = 'earthengine'):
+  def  __init__(self, api, boundaries_path, start_date,end_date, cloud_percentage,function='mosaic', folder = 'earthengine', result_cache=True):
     """
       Description: 
         This method is called when an object is created from the class download_s2_images and it allow the class to initialize the attributes
@@ -48,6 +75,7 @@ class download_s2_images(object):
         @ start_date , end_date : range in which the data will be downloaded
         @ function [mosaic, median] : which method to apply to the image collection
         @ folder : where images will be store on the google drive
+        @ result_cache : when True an export identical to a previous one is reused instead of creating a new task (see getTask)
       Returns:
         
     """
@@ -61,6 +89,15 @@ class download_s2_images(object):
     self.cloud_percentage = cloud_percentage 
     self.function = function
     self.folder = folder
+    self.reference_images = {}
+    self.compiled_products = {}
+    self.result_cache = result_cache
+    self.results = None
+    self.task_states = None
+    self.saved_exports = 0
+    self.footprints = None
+    self.aoi_footprint = None
+    self.intersection_end = None
     
 
   #================================================================================================
@@ -258,7 +295,7 @@ class download_s2_images(object):
   def mask_permanent_water(self, init_image , date_range_ =['2021-01-01' ,'2021-01-10'] ):
           di = date_range_[0] # init_date
           df = date_range_[1] # end_date
-          image1 = self.api.ImageCollection("COPERNICUS/S2_SR").filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 15)).filter(ee.Filter.date(di, df)).select('B.*', 'SCL').filter(ee.Filter.bounds(self.getGeometry())).mosaic()
+          image1 = self.api.ImageCollection("COPERNICUS/S2_SR").filter(self.api.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 15)).filter(self.api.Filter.date(di, df)).select('B.*', 'SCL').filter(self.api.Filter.bounds(self.getGeometry())).mosaic()
 
           swi= image1.normalizedDifference(['B3', 'B11']).rename(['swi']); 
           swi_mask = swi.gt(0).updateMask(swi.gt(0));
@@ -266,7 +303,7 @@ class download_s2_images(object):
       #  Include JRC layer on surface water seasonality to mask flood pixels from areas
       #  of "permanent" water (where there is water > 2 months of the year)
           single_img = init_image
-          swater = ee.Image('JRC/GSW1_0/GlobalSurfaceWater').select('seasonality');  
+          swater = self.api.Image('JRC/GSW1_0/GlobalSurfaceWater').select('seasonality');  
           swater_mask = swater.gte(2).updateMask(swater.gte(2));  
           single_img_up = single_img.where(swater_mask,100);  
           
@@ -274,6 +311,165 @@ class download_s2_images(object):
           single_img  = single_img .updateMask(single_img.neq(100));
           return single_img
 
+  #================================================================================================
+  #  SCENE FOOTPRINTS AND AOI COVERAGE
+  #================================================================================================
+  @staticmethod
+  def add_days(x, days):
+    """
+      Description:
+        add a number of days to a date
+      Args:
+        @ x : date (YYYY-MM-DD)
+        @ days : number of days
+      Returns:
+        - the new date (YYYY-MM-DD)
+    """
+    return (datetime.strptime(str(x), "%Y-%m-%d") + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+  def getFootprints(self):
+    """
+      Description:
+        fetch the footprints of all the candidate scenes and the AOI in a single metadata call and keep
+        them locally, in a UTM projection, with a spatial index (STRtree) on the footprints
+      Args:
+        @ self:
+      Returns:
+        - GeoDataFrame of the footprints (one row per scene, with its acquisition date)
+    """
+    import geopandas as gpd
+    from shapely.geometry import shape
+
+    def footprintDriver(image):
+      image = self.api.Image(image)
+      return self.api.Feature(image.geometry(), {'date': image.date().format("YYYY-MM-dd")})
+
+    info = self.api.Dictionary({
+        'aoi': self.getGeometry(),
+        'footprints': self.api.FeatureCollection(self.getImages().map(footprintDriver)),
+      }).getInfo()
+
+    aoi = gpd.GeoSeries([shape(info['aoi'])], crs='EPSG:4326')
+    crs = aoi.estimate_utm_crs()
+    self.aoi_footprint = aoi.to_crs(crs).iloc[0]
+    footprints = gpd.GeoDataFrame.from_features(info['footprints']['features'], crs='EPSG:4326')
+    if len(footprints) > 0:
+      footprints = footprints.to_crs(crs)
+      # only the scenes that intersect the AOI, using the spatial index
+      footprints = footprints.iloc[footprints.sindex.query(self.aoi_footprint, predicate='intersects')]
+    self.footprints = footprints
+    self.intersection_end = None
+    return footprints
+
+
+  def getCoverage(self, start_date, end_date):
+    """
+      Description:
+        fraction of the AOI covered by the scenes acquired in [start_date, end_date[
+      Args:
+        @ self:
+        @ start_date, end_date : date window (YYYY-MM-DD)
+      Returns:
+        - the covered fraction (0 to 1)
+    """
+    if self.footprints is None:
+      self.getFootprints()
+    if len(self.footprints) == 0:
+      return 0.0
+    in_window = self.footprints[(self.footprints['date'] >= start_date) & (self.footprints['date'] < end_date)]
+    if len(in_window) == 0:
+      return 0.0
+    return in_window.union_all().intersection(self.aoi_footprint).area / self.aoi_footprint.area
+
+
+  def getCoverage_table(self, next_date=1):
+    """
+      Description:
+        fraction of the AOI covered for every acquisition date (date, date + next_date)
+      Args:
+        @ self:
+        @ next_date : see collectByDate
+      Returns:
+        - dictionary {date : covered fraction}
+    """
+    if self.footprints is None:
+      self.getFootprints()
+    dates = sorted(set(self.footprints['date'])) if len(self.footprints) > 0 else []
+    return {d: self.getCoverage(d, self.add_days(d, next_date)) for d in dates}
+
+
+  def getIntersection_window(self, image_intersect, start_date, end_date, merge=True, max_merge_days=10):
+    """
+      Description:
+        the skip / merge decision of img_intersection, without building any image (also used by plan).
+        A partially covered window is merged with the next acquisitions until the coverage is reached
+        (the dates merged are then skipped)
+      Args:
+        @ self:
+        @ image_intersect : minimum fraction of the AOI to cover (True means 0.99)
+        @ start_date, end_date : date window
+        @ merge : when False the partially covered windows are only skipped
+        @ max_merge_days : maximum length (days) of a merged window
+      Returns:
+        - the end date of the window (None when the window is skipped) and its coverage
+    """
+    min_coverage = 0.99 if image_intersect is True else float(image_intersect)
+
+    # date already merged into a previous window
+    if self.intersection_end is not None and start_date < self.intersection_end:
+      return None, None
+
+    coverage = self.getCoverage(start_date, end_date)
+    if coverage >= min_coverage:
+      return end_date, coverage
+    if merge == False:
+      print('skip', start_date, end_date, 'coverage', round(coverage, 3))
+      return None, coverage
+
+    acquisition_dates = sorted(d for d in set(self.footprints['date']) if end_date <= d < self.add_days(start_date, max_merge_days))
+    for acquisition_date in acquisition_dates:
+      merged_end = self.add_days(acquisition_date, 1)
+      coverage = self.getCoverage(start_date, merged_end)
+      if coverage >= min_coverage:
+        self.intersection_end = merged_end
+        print('merge', start_date, merged_end, 'coverage', round(coverage, 3))
+        return merged_end, coverage
+
+    print('skip', start_date, end_date, 'coverage', round(coverage, 3))
+    return None, coverage
+
+
+  def img_intersection(self, image_intersect, single_img, start_date, end_date, merge=True, mask=False,
+                       max_merge_days=10, snow_probability=5, cloud_probability=30):
+    """
+      Description:
+        keep an image only when its scenes cover enough of the AOI. A partially covered date is merged
+        with the next acquisitions until the coverage is reached (see getIntersection_window)
+      Args:
+        @ self:
+        @ image_intersect : minimum fraction of the AOI to cover (True means 0.99)
+        @ single_img : composite of the window
+        @ start_date, end_date : date window of single_img
+        @ merge : when False the partially covered windows are only skipped
+        @ mask : when True the merged composite is built from the cloud masked images
+        @ max_merge_days : maximum length (days) of a merged window
+      Returns:
+        - the image (None when the window is skipped) and the end date of the window
+    """
+    window_end, coverage = self.getIntersection_window(image_intersect, start_date, end_date, merge=merge, max_merge_days=max_merge_days)
+    if window_end is None:
+      return None, None
+    if window_end == end_date:
+      return single_img, end_date
+
+    if mask == False:
+      merged = self.setImage(start_date, window_end)
+    else:
+      merged = self.setMask_images(start_date, window_end, snow_probability=snow_probability, cloud_probability=cloud_probability)
+    merged_img = merged.mosaic() if self.function == 'mosaic' else merged.median()
+    return merged_img, window_end
+
   #================================================================================================
   #    INITIALISE A TASK
   #================================================================================================
@@ -281,17 +477,18 @@ class download_s2_images(object):
     """
         Description: 
           a function that generate a task  
+          When the result cache is enabled, a task whose image expression and export parameters are
+          identical to a previous export is not created again : the previous output is reused
         Args: 
           @ self:
           @ image : 
           @ file_name : 
           @ start_date, end_date : date range
         Returns:
-          -  a GEE task
+          -  a GEE task (a result_task with the result cache, a cached_task when the output already exists)
     """
     aoi = self.getGeometry()
-    task = self.api.batch.Export.image.toDrive(
-       **{
+    params = {
                  'image': image,
                  'description':filename,
                  'folder': self.folder,
@@ -301,9 +498,271 @@ class download_s2_images(object):
                   'maxPixels': 1e12,
                   'fileFormat': "GeoTIFF",
          }
-       )
+
+    if self.result_cache != False:
+      key = self.getResult_key(params)
+      entry = self.getCached_result(key)
+      if entry is not None:
+        print('reuse', entry['location'])
+        return cached_task(key, entry)
+
+    task = self.api.batch.Export.image.toDrive(**params)
+
+    if self.result_cache != False:
+      # the output is only registered once the task is started (see result_task)
+      return result_task(self, key, task, {'location': 'drive:' + self.folder + '/' + filename + '.tif', 'description': filename})
     return task
-    
+
+  #================================================================================================
+  #    RESULT CACHE
+  #================================================================================================
+  def getResult_key(self, params):
+    """
+        Description:
+          content key of an export : hash of the normalized serialized image expression and of the
+          export parameters that change the output (not the names)
+        Args:
+          @ self:
+          @ params : parameters of the export
+        Returns:
+          -  the key (sha256)
+    """
+    import hashlib
+    import json
+
+    content = {
+        'image': json.loads(params['image'].serialize()),
+        'region': json.loads(params['region'].serialize()),
+        'scale': params['scale'],
+        'maxPixels': params['maxPixels'],
+        'fileFormat': params['fileFormat'],
+      }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+  def getResults(self):
+    """
+        Description:
+          the result cache {key : output location}, loaded from folder/results_cache.json
+        Args:
+          @ self:
+        Returns:
+          -  the cache dictionary
+    """
+    import json
+
+    if self.results is None:
+      self.results = {}
+      cache_file = os.path.join(self.folder, 'results_cache.json')
+      if os.path.exists(cache_file):
+        with open(cache_file) as f:
+          self.results = json.load(f)
+    return self.results
+
+
+  def register_result(self, key, entry):
+    """
+        Description:
+          save the output location of an export in the result cache
+        Args:
+          @ self:
+          @ key : content key of the export (see getResult_key)
+          @ entry : dictionary with the location of the output (a None value removes the field)
+        Returns:
+          -  the entry
+    """
+    entry = dict(entry, created=datetime.now().isoformat())
+    return self.save_results({key: entry})[key]
+
+
+  def save_results(self, changes):
+    """
+        Description:
+          merge changes in folder/results_cache.json. Several processes (run_worker) share the cache :
+          the file is read again and updated under a lock, and replaced atomically so that a reader never
+          sees a truncated file
+        Args:
+          @ self:
+          @ changes : {key : entry (merged with the cached entry), or None to remove the entry}
+        Returns:
+          -  the cache dictionary
+    """
+    import json
+
+    cache_file = os.path.join(self.folder, 'results_cache.json')
+    with _file_lock(cache_file + '.lock'):
+      results = {}
+      if os.path.exists(cache_file):
+        with open(cache_file) as f:
+          results = json.load(f)
+      for key, entry in changes.items():
+        if entry is None:
+          results.pop(key, None)
+          continue
+        merged = dict(results.get(key, {}), **entry)
+        results[key] = {field: value for field, value in merged.items() if value is not None}
+      tmp_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+      with open(tmp_file, 'w') as f:
+        json.dump(results, f, indent=1)
+      os.replace(tmp_file, cache_file)
+    self.results = results
+    return results
+
+
+  def getCached_result(self, key):
+    """
+        Description:
+          the cached output of an export. An output is reused when it has a local copy or when its task
+          is COMPLETED, or still in flight (UNSUBMITTED, READY, RUNNING : the output of that task is
+          reused instead of exporting it again). The states of the tasks are listed once per run. The
+          exports whose task failed or was cancelled are removed
+        Args:
+          @ self:
+          @ key : content key of the export (see getResult_key)
+        Returns:
+          -  the cache entry, None when the output does not exist
+    """
+    entry = self.getResults().get(key)
+    if entry is None:
+      return None
+    if 'local_path' in entry and os.path.exists(entry['local_path']):
+      return entry
+    if entry.get('state') == 'COMPLETED':
+      return entry
+    if 'task_id' not in entry:
+      self.save_results({key: None})
+      return None
+
+    if self.task_states is None:
+      self.task_states = {task.id: task.state for task in self.api.batch.Task.list()}
+    state = self.task_states.get(entry['task_id'])
+    if state == 'COMPLETED':
+      # the state is kept, the task will disappear from Task.list
+      return self.register_result(key, {'state': 'COMPLETED'})
+    if state in ['UNSUBMITTED', 'READY', 'RUNNING']:
+      return dict(entry, state=state)
+    if state in ['FAILED', 'CANCELLED', 'CANCEL_REQUESTED']:
+      self.save_results({key: None})
+    return None
+
+
+  def cache_local_result(self, task, local_file, max_bytes=5e9):
+    """
+        Description:
+          keep a local copy of a downloaded output in the result cache (folder/RESULTS_CACHE). The local
+          copies are evicted (least recently used first) when the cache is larger than max_bytes
+        Args:
+          @ self:
+          @ task : the task (result_task or cached_task) of the output, or its content key
+          @ local_file : the downloaded file
+          @ max_bytes : maximum size of the local copies
+        Returns:
+          -  path of the local copy
+    """
+    import shutil
+
+    key = task if isinstance(task, str) else getattr(task, 'key', None)
+    if key is None:
+      # the key of a task is the one registered under its id
+      keys = [k for k, entry in self.getResults().items() if entry.get('task_id') == task.id]
+      if len(keys) == 0:
+        raise ValueError('the task ' + str(task.id) + ' is not in the result cache')
+      key = keys[-1]
+
+    cache_dir = os.path.join(self.folder, 'RESULTS_CACHE')
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    local_copy = os.path.join(cache_dir, key + os.path.splitext(local_file)[1])
+    shutil.copyfile(local_file, local_copy)
+    self.register_result(key, {'local_path': local_copy})
+
+    self.evict_cache(cache_dir, max_bytes)
+    evicted = {k: {'local_path': None} for k, entry in self.getResults().items()
+               if 'local_path' in entry and not os.path.exists(entry['local_path'])}
+    if evicted:
+      self.save_results(evicted)
+    return local_copy
+
+
+  def getLocal_result(self, key):
+    """
+        Description:
+          local copy of a cached output (its last access time is updated for the LRU eviction)
+        Args:
+          @ self:
+          @ key : content key of the export
+        Returns:
+          -  path of the local copy, None when there is no local copy
+    """
+    entry = self.getResults().get(key, {})
+    local_path = entry.get('local_path')
+    if local_path is None or not os.path.exists(local_path):
+      return None
+    os.utime(local_path)
+    return local_path
+
+  #================================================================================================
+  # PRODUCT REGISTRY
+  #================================================================================================
+  def getIndices(self):
+    """
+        Description:
+          names of the spectral indices of the registry (single band float products)
+        Args:
+          @ self:
+        Returns:
+          -  list of the index names
+    """
+    return [name for name, spec in self.products.items() if spec['math'] not in ['visualize', 'select']]
+
+
+  def getProduct(self, name):
+    """
+        Description:
+          compile the band math of a product of the registry into a function. The function is compiled
+          once per run and shared by the export, visualization and statistics paths
+        Args:
+          @ self:
+          @ name : name of the product in the registry
+        Returns:
+          -  a function image -> product image
+    """
+    if name not in self.compiled_products:
+      spec = self.products[name]
+      if spec['math'] == 'normalized_difference':
+        def product(image):
+          return image.normalizedDifference(spec['bands']).rename([name])
+      elif spec['math'] == 'visualize':
+        def product(image):
+          return image.visualize(**spec['vis'])
+      elif spec['math'] == 'select':
+        def product(image):
+          return image.select(spec['bands'])
+      else:
+        def product(image):
+          return image.expression(spec['math'], {band: image.select(band) for band in spec['bands']}).rename([name])
+      self.compiled_products[name] = product
+    return self.compiled_products[name]
+
+
+  def getProduct_task(self, name, file_name, image):
+    """
+        Description:
+          a function that generate a task to download a product of the registry, cast to its dtype
+        Args:
+          @ self:
+          @ name : name of the product in the registry
+          @ file_name : name of the images
+          @ image : image on which the product is computed
+        Returns:
+          -  a task
+    """
+    geometry = self.getGeometry()
+    product = self.getProduct(name)(image.clip(geometry))
+    product = getattr(product, self.dtypes[self.products[name]['dtype']][0])()
+    task = self.getTask(product, file_name)
+    return task
+
   #================================================================================================
   # NDVI TASK
   #================================================================================================
@@ -318,18 +777,7 @@ class download_s2_images(object):
         Returns:
           -  a task
     """
-    ndvi_name = ndvi_name #+ 'ndvi_'+ self.start_date+'to'+ self.end_date +'_cloudval-'+ str(self.cloud_percentage)
-    print(ndvi_name)
-    geometry = self.getGeometry()
-    image = image 
-    #print('image')
-    #print(image)
-    ndvi = image.normalizedDifference(['B8', 'B4']).rename(['ndvi']);
-    #print(ndvi)
-    visualized_ndvi = ndvi.clip(geometry)
- 
-    task = self.getTask(visualized_ndvi, ndvi_name  )
-    return  task
+    return self.getProduct_task('ndvi', ndvi_name, image)
 
   #================================================================================================
   # MNDWI TASK
@@ -345,24 +793,7 @@ class download_s2_images(object):
         Returns:
           -  a task
     """
-    mndwi_name = mndwi_name #+'_mndwi_' #+ self.start_date+'to'+ self.end_date +'_cloudval-'+ str(self.cloud_percentage)
-    geometry = self.getGeometry()
-    image = image
-
-    mndwiVis = {'min':0, 'max':0.5, 'palette': ['white', 'blue']}
-    mndwi = image.normalizedDifference(['B3', 'B11']).rename(['mndwi']);
-    
-    #==========================MASK PERMANENT WATER===============================
-
-    #========================== MASK PERMANENT WATER===============================
-
-    visualized_mndwi = mndwi.clip(geometry)
-
-    # task = self.getTask(color_mndwi ,mndwi_name)
-    task = self.getTask(visualized_mndwi,mndwi_name)
-    return task
-
-
+    return self.getProduct_task('mndwi', mndwi_name, image)
 
   #================================================================================================
   #
@@ -378,15 +809,7 @@ class download_s2_images(object):
         Returns:
           -  a task
     """
-    ndwi_name = ndwi_name # + 'ndwi_' +self.start_date+'to'+ self.end_date +'_cloudval-'+ str(self.cloud_percentage)
-    geometry = self.getGeometry()
-    image = image
-
-    ndwi = image.normalizedDifference(['B8', 'B11']).rename(['ndwi']); 
-    visualized_ndwi = ndwi.clip(geometry)
-
-    task = self.getTask(visualized_ndwi, ndwi_name )
-    return task
+    return self.getProduct_task('ndwi', ndwi_name, image)
 
   #================================================================================================
   #  RGB TASK
@@ -402,21 +825,7 @@ class download_s2_images(object):
         Returns:
           -  a task
     """
-
-    rgb_name = rgb_name 
-    geometry = self.getGeometry()
-    image = image
-    rgbVis = {
-      'min': 0.0,
-      'max': 3000,
-      'bands': ['B4', 'B3', 'B2']
-      } 
-
-    visualized_rgb = image.clip(geometry).visualize(**rgbVis); #.visualize(image)
-
-    task1 = self.getTask(visualized_rgb, rgb_name )
-    
-    return task1
+    return self.getProduct_task('rgb', rgb_name, image)
 
   #================================================================================================
   #  S2CLOUDLESS TASK
@@ -432,14 +841,7 @@ class download_s2_images(object):
         Returns:
           -  a task
     """
-    geometry = self.getGeometry()
-    image = image
-    cloud_img = image.clip(geometry)
-
-    task = self.getTask(cloud_img, cloud_name)
-    return task
-
-
+    return self.getProduct_task('cloud', cloud_name, image)
 
   #================================================================================================
   # SWI TASK
@@ -455,79 +857,128 @@ class download_s2_images(object):
         Returns:
           -  a task
     """
-    swi_name = swi_name #+'_mndwi_' #+ self.start_date+'to'+ self.end_date +'_cloudval-'+ str(self.cloud_percentage)
+    if image is False:
+      image = self.getImages().mosaic()
+    return self.getProduct_task('swi', swi_name, image)
+
+  #================================================================================================
+  # CHANGE DETECTION TASK
+  #================================================================================================
+  def getReference_image(self, index, date_range_):
+    """
+        Description:
+          reference index composite of the change products, built with the same window logic as
+          mask_permanent_water. It is built once per index and date range and reused for every date
+        Args:
+          @ self:
+          @ index : index of the reference [mndwi, ndwi, ndvi, swi]
+          @ date_range_ : [start_date, end_date] of the reference window
+        Returns:
+          -  the reference index image
+    """
+    key = (index, date_range_[0], date_range_[1])
+    if key not in self.reference_images:
+      reference = self.api.ImageCollection("COPERNICUS/S2_SR").filter(self.api.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 15)).filter(self.api.Filter.date(date_range_[0], date_range_[1])).filter(self.api.Filter.bounds(self.getGeometry())).mosaic()
+      self.reference_images[key] = self.getIndex_image([index], reference)
+    return self.reference_images[key]
+
+
+  def getChange_task(self, change_name, image, index='mndwi', reference_range=False, threshold=False, as_uint8=False):
+    """
+        Description:
+          a function that generate a task to download the difference between the index of the image
+          and the index of a reference composite, so that pre/post products are not exported separately
+        Args:
+          @ self:
+          @ change_name : name of the images
+          @ index : index on which the change is computed [mndwi, ndwi, ndvi, swi]
+          @ reference_range : [start_date, end_date] of the reference composite
+          @ threshold : when set (0 included), a change mask (uint8) is exported instead of the difference
+            (0 : no change, 1 : increase > threshold, 2 : decrease < -threshold)
+          @ as_uint8 : export as uint8. The difference [-1, 1] is then rescaled to [0, 200]
+        Returns:
+          -  a task
+    """
+    if reference_range == False:
+      raise ValueError('change products need a reference date range (change_reference)')
+
     geometry = self.getGeometry()
-    if image==False:
-      image = self.getImage() 
-    else:
-      image = image
-    swiVis = {'min':0, 'max':0.5, 'palette': ['white', 'blue']}
-    swi = image.normalizedDifference(['B5', 'B11']).rename(['swi']);
-    visualized_swi = swi.clip(geometry)
+    reference = self.getReference_image(index, reference_range)
+    change = self.getIndex_image([index], image).subtract(reference).rename([index + '_change'])
 
-    task = self.getTask(visualized_swi,swi_name)
+    if threshold is not False and threshold is not None:
+      change = change.gt(threshold).add(change.lt(-threshold).multiply(2)).rename([index + '_change']).toUint8()
+    elif as_uint8:
+      change = change.add(1).multiply(100).round().toUint8()
+
+    task = self.getTask(change.clip(geometry), change_name)
     return task
+
    #-----------------------------------------------------------------------------------------------
     #                       CALL TASKS
     #-----------------------------------------------------------------------------------------
-  def call_task(self, types, image_name, single_img ):
-            
-        if 'rgb' in types:
+  def call_task(self, types, image_name, single_img, change_reference=False, change_threshold=False, change_uint8=False ):
 
-          return (self.getrgb_img_task('rgb_'+image_name ,single_img))
-          
-        if 'mndwi' in types:
-          return (self.getMNDWI_task('mndwi_'+image_name ,single_img))
+        for index in self.getIndices():
+          if index + '_change' in types:
+            return (self.getChange_task(index + '_change_'+image_name ,single_img, index=index, reference_range=change_reference,
+                                        threshold=change_threshold, as_uint8=change_uint8))
 
-        if 'ndvi' in types:
-          return (self.getNDVI_task('ndvi_'+image_name ,single_img))
+        product = self.getTask_product(types)
+        if product is not None:
+          return (self.getProduct_task(product, product + '_' + image_name, single_img))
 
-        if 'swi' in types:
-          return (self.getNDVI_task('swi_'+image_name ,single_img))
 
-        if 'ndwi' in types:
-          return (self.getNDVI_task('ndwi_'+image_name ,single_img))
-  
+  def getTask_product(self, types):
+    """
+        Description:
+          the product exported by call_task for the given types (call_task exports the first match only)
+        Args:
+          @ self:
+          @ types : type of images to be downloaded
+        Returns:
+          -  the product name, None when call_task creates no task
+    """
+    for index in self.getIndices():
+      if index + '_change' in types:
+        return index + '_change'
+    for name, spec in self.products.items():
+      if name in types and spec['collection'] == 'COPERNICUS/S2_SR':
+        return name
+    return None
+
 
   def call_viz_image(self, types, single_img ):
 
-      if 'rgb' in types:
-            rgbVis = {
-              'min': 0.0,
-              'max': 3000,
-              'bands': ['B4', 'B3', 'B2']
-              } 
-
-            visualized_im  = single_img.clip(  self.getGeometry()).visualize(**rgbVis)
-
-            # visualized_im  = visualized_im .updateMask(visualized_im .gt(0))
-            return  visualized_im
-            # list_images.append(visualized_rgb)
-            # list_image_names.append(str(date))
-
-      if 'ndvi' in types:
-            ndvim = single_img.normalizedDifference(['B8', 'B4']).rename(['ndvi']);
-            Vis = {'min':0, 'max':0.8, 'palette': ['white', 'green']}
-            visualized_im = ndvim.clip(  self.getGeometry()).visualize(**Vis)
-            return  visualized_im
-
-      if 'mndwi' in types:
-            ndvim = single_img.normalizedDifference(['B3', 'B11']).rename(['ndvi']);
-            Vis = {'min':0, 'max':0.8, 'palette': ['white', 'blue']}
-            visualized_im = ndvim.clip(  self.getGeometry()).visualize(**Vis)
-            return  visualized_im
-
-      if 'swi' in types:
-            ndvim = single_img.normalizedDifference(['B5', 'B11']).rename(['ndvi']);
-            Vis = {'min':0, 'max':0.8, 'palette': ['white', 'blue']}
-            visualized_im = ndvim.clip(  self.getGeometry()).visualize(**Vis)
-            return  visualized_im
-
-      if 'ndwi' in types:
-            ndvim = single_img.normalizedDifference(['B8', 'B11']).rename(['ndvi']);
-            Vis = {'min':0, 'max':0.8, 'palette': ['white', 'blue']}
-            visualized_im = ndvim.clip(  self.getGeometry()).visualize(**Vis)
-            return  visualized_im
+      for name, spec in self.products.items():
+        if name in types and spec['collection'] == 'COPERNICUS/S2_SR':
+          product = self.getProduct(name)(single_img.clip(self.getGeometry()))
+          if spec['math'] == 'visualize':
+            return product
+          return product.visualize(**spec['vis'])
+
+  #================================================================================================
+  #  INDEX IMAGE (NO VISUALIZATION)
+  #================================================================================================
+  def getIndex_image(self, types, single_img):
+    """
+        Description:
+          compute the raw spectral indices requested in types as one multi-band image
+          (one band per index, named after the index). rgb and cloud are ignored
+        Args:
+          @ self:
+          @ types : list of indices [mndwi, ndwi, ndvi, swi]
+          @ single_img : the image on which the indices are computed
+        Returns:
+          -  an image with one band per index
+    """
+    image = None
+    for name in types:
+      if name not in self.getIndices():
+        continue
+      index = self.getProduct(name)(single_img)
+      image = index if image is None else image.addBands(index)
+    return image
 
 
 #========================================================
@@ -535,6 +986,8 @@ class download_s2_images(object):
 #============================================================
   def export_geemap_to_html(self,list_images, list_image_names, output_folder, centerpoint = [0,0,2]):
 
+    import geemap
+
     i =0
     Map = geemap.Map(toolbar_ctrl=True, layer_ctrl=True)
     aoi = self.getGeometry()
@@ -565,11 +1018,262 @@ class download_s2_images(object):
               
     return Map
 
+  #================================================================================================
+  #  LAZY TILE-LAYER HTML MAP
+  #================================================================================================
+  def getMap_tiles(self, list_images, cache_file, max_workers=8, cache_hours=12):
+    """
+      Description:
+        get the tile url templates of a list of images. The map id requests are sent concurrently and the
+        templates are cached on disk (keyed on the serialized image) until they expire
+      Args:
+        @ self:
+        @ list_images : list of images (already visualized)
+        @ cache_file : JSON file of the cache
+        @ max_workers : number of concurrent map id requests
+        @ cache_hours : lifetime of a cached map id
+      Returns:
+        - list of the tile url templates
+    """
+    import hashlib
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+
+    cache = {}
+    if os.path.exists(cache_file):
+      with open(cache_file) as f:
+        cache = json.load(f)
+    now = datetime.now().timestamp()
+    cache = {key: value for key, value in cache.items() if value['expires'] > now}
+
+    keys = [hashlib.sha1(image.serialize().encode()).hexdigest() for image in list_images]
+    missing = {key: image for key, image in zip(keys, list_images) if key not in cache}
+
+    def mapidDriver(image):
+      return image.getMapId({})['tile_fetcher'].url_format
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      urls = list(executor.map(mapidDriver, missing.values()))
+    for key, url in zip(missing, urls):
+      cache[key] = {'url': url, 'expires': now + cache_hours * 3600}
+
+    with open(cache_file, 'w') as f:
+      json.dump(cache, f)
+    return [cache[key]['url'] for key in keys]
+
+
+  def export_tiles_to_html(self, list_images, list_image_names, output_folder, centerpoint = [0,0,2], max_workers=8, cache_hours=12):
+    """
+      Description:
+        lightweight alternative to export_geemap_to_html. The map ids are requested concurrently (and
+        reused from the cache of a previous export) and the page is a plain Leaflet map in which the
+        tiles of a date are only loaded when its layer is toggled
+      Args:
+        @ self:
+        @ list_images : list of images (already visualized)
+        @ list_image_names : name of the layers
+        @ output_folder : the map is written in output_folder/HTML_MAPS
+        @ centerpoint : [lon, lat, zoom]
+        @ max_workers : number of concurrent map id requests
+        @ cache_hours : lifetime of a cached map id
+      Returns:
+        - path of the html file
+    """
+    import json
+
+    download_dir = os.path.join(os.path.expanduser(output_folder), 'HTML_MAPS')
+    if not os.path.exists(download_dir):
+      os.makedirs(download_dir)
+
+    urls = self.getMap_tiles(list_images, os.path.join(download_dir, 'tiles_cache.json'), max_workers=max_workers, cache_hours=cache_hours)
+    layers = [{'name': str(name), 'url': url} for name, url in zip(list_image_names, urls)]
+    aoi = self.getGeometry().getInfo()
+
+    html = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8"/>
+<title>My Map</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {width: 100%; height: 100%; margin: 0;}</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var layers = __LAYERS__;
+var map = L.map('map').setView([__LAT__, __LON__], __ZOOM__);
+var base = L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {attribution: 'OpenStreetMap'}).addTo(map);
+var contour = L.geoJSON(__AOI__, {style: {fill: false}}).addTo(map);
+var overlays = {' Contour': contour};
+// a tile layer does not request any tile until it is added to the map
+layers.forEach(function (layer) { overlays[layer.name] = L.tileLayer(layer.url); });
+L.control.layers({'OpenStreetMap': base}, overlays).addTo(map);
+</script>
+</body>
+</html>
+"""
+    html = (html.replace('__LAT__', str(centerpoint[1])).replace('__LON__', str(centerpoint[0])).replace('__ZOOM__', str(centerpoint[2]))
+                .replace('__AOI__', json.dumps(aoi)).replace('__LAYERS__', json.dumps(layers)))
+
+    html_name = 'my_map' + datetime.now().strftime('%Y-%m-%d%H%M%f') + '.html'
+    html_file = os.path.join(download_dir, html_name)
+    with open(html_file, 'w') as f:
+      f.write(html)
+    return html_file
+
+  #================================================================================================
+  #  QUICKLOOKS
+  #================================================================================================
+  def evict_cache(self, cache_dir, max_bytes):
+    """
+      Description:
+        remove the least recently used files of a cache folder until it is smaller than max_bytes
+      Args:
+        @ self:
+        @ cache_dir : cache folder
+        @ max_bytes : maximum size of the folder
+      Returns:
+        - number of files removed
+    """
+    files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+    files = sorted((f for f in files if os.path.isfile(f)), key=os.path.getmtime)
+    total = sum(os.path.getsize(f) for f in files)
+    removed = 0
+    for f in files:
+      if total <= max_bytes:
+        break
+      total -= os.path.getsize(f)
+      os.remove(f)
+      removed += 1
+    return removed
+
+
+  def getQuicklooks(self, list_images, cache_dir, dimensions=256, file_format='png', max_workers=8, cache_bytes=200e6):
+    """
+      Description:
+        download small thumbnails of a list of images concurrently. The thumbnails are cached on disk,
+        keyed on the serialized image and the thumbnail parameters, with a LRU eviction
+      Args:
+        @ self:
+        @ list_images : list of images (already visualized)
+        @ cache_dir : cache folder
+        @ dimensions : size (pixels) of the largest side of the thumbnails
+        @ file_format : png or jpg
+        @ max_workers : number of concurrent downloads
+        @ cache_bytes : maximum size of the cache
+      Returns:
+        - list of the thumbnail files
+    """
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.request import urlopen
+
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+
+    region = self.getGeometry()
+    params = {'dimensions': dimensions, 'region': region, 'format': file_format}
+    keys = [hashlib.sha1((image.serialize() + str(dimensions) + file_format).encode()).hexdigest() for image in list_images]
+    files = [os.path.join(cache_dir, key + '.' + file_format) for key in keys]
+
+    def thumbDriver(item):
+      image, thumb_file = item
+      if os.path.exists(thumb_file):
+        os.utime(thumb_file)
+        return thumb_file
+      with urlopen(image.getThumbURL(params)) as response:
+        content = response.read()
+      with open(thumb_file, 'wb') as f:
+        f.write(content)
+      return thumb_file
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      list(executor.map(thumbDriver, zip(list_images, files)))
+
+    self.evict_cache(cache_dir, max(cache_bytes, sum(os.path.getsize(f) for f in files)))
+    return files
+
+
+  def getContact_sheet(self, thumb_files, names, sheet_file, columns=6, dimensions=256):
+    """
+      Description:
+        assemble thumbnails into a single contact sheet, each one labelled with its name
+      Args:
+        @ self:
+        @ thumb_files : list of the thumbnail files
+        @ names : label of each thumbnail
+        @ sheet_file : output image
+        @ columns : number of thumbnails per row
+        @ dimensions : size of a cell of the sheet
+      Returns:
+        - path of the contact sheet
+    """
+    from PIL import Image, ImageDraw
+
+    rows = max(1, -(-len(thumb_files) // columns))
+    label = 16
+    sheet = Image.new('RGB', (columns * dimensions, rows * (dimensions + label)), 'white')
+    draw = ImageDraw.Draw(sheet)
+    for i, (thumb_file, name) in enumerate(zip(thumb_files, names)):
+      x = (i % columns) * dimensions
+      y = (i // columns) * (dimensions + label)
+      with Image.open(thumb_file) as thumb:
+        thumb.thumbnail((dimensions, dimensions))
+        sheet.paste(thumb.convert('RGB'), (x, y + label))
+      draw.text((x + 2, y + 2), str(name), fill='black')
+    sheet.save(sheet_file)
+    return sheet_file
+
+
+  def getAll_quicklooks(self, types=['rgb'], mask=False, mask_water=False, next_date=1, dimensions=256, file_format='png',
+                        max_workers=8, cache_bytes=200e6, columns=6, snow_probability=5, cloud_probability=30):
+    """
+      Description:
+        quicklook of a whole run for QA : the images visualized by call_viz_image are downloaded as small
+        thumbnails (concurrently, with a disk cache) and assembled into a contact sheet
+      Args:
+        @ self:
+        @ types : type of images (see call_viz_image)
+        @ mask : when True the cloud masked collection is used
+        @ mask_water : [start_date, end_date] used to mask the permanent water, False to disable
+        @ next_date : see collectByDate
+        @ dimensions : size (pixels) of the thumbnails
+        @ file_format : png or jpg
+        @ max_workers : number of concurrent downloads
+        @ cache_bytes : maximum size of the thumbnail cache (folder/QUICKLOOKS/cache)
+        @ columns : number of thumbnails per row of the contact sheet
+      Returns:
+        - path of the contact sheet and list of the thumbnail files
+    """
+    if mask == False:
+      collection = self.collectByDate(self.getImages(), next_date=next_date)
+    else:
+      collection = self.collectByDate(self.getMask_images(snow_probability=snow_probability, cloud_probability=cloud_probability), next_date=next_date)
+
+    # a single round trip for all the dates
+    dates = collection.aggregate_array('system:id').getInfo()
+    image_list = collection.toList(len(dates))
+
+    list_images = []
+    for i in range(len(dates)):
+      single_img = self.api.Image(image_list.get(i))
+      if mask_water != False:
+        single_img = self.mask_permanent_water(single_img, date_range_=[mask_water[0], mask_water[1]])
+      list_images.append(self.call_viz_image(types, single_img))
+
+    quicklook_dir = os.path.join(os.path.expanduser(self.folder), 'QUICKLOOKS')
+    thumb_files = self.getQuicklooks(list_images, os.path.join(quicklook_dir, 'cache'), dimensions=dimensions, file_format=file_format,
+                                     max_workers=max_workers, cache_bytes=cache_bytes)
+    sheet_file = os.path.join(quicklook_dir, '_'.join(['quicklook'] + list(types) + [self.start_date, self.end_date]) + '.png')
+    self.getContact_sheet(thumb_files, dates, sheet_file, columns=columns, dimensions=dimensions)
+    return sheet_file, thumb_files
+
   #================================================================================================
   #
   #================================================================================================
 
-  def getAll_images(self, types=['mndwi','rgb', 'cloud', 'swi'], mask=False, mask_water = False,image_intersect=False,export_image= False, next_date=1, snow_probability=5, cloud_probability =30 ):
+  def getAll_images(self, types=['mndwi','rgb', 'cloud', 'swi'], mask=False, mask_water = False,image_intersect=False,export_image= False, next_date=1, snow_probability=5, cloud_probability =30, change_reference=False, change_threshold=False, change_uint8=False, plan=False, lazy_html=False, bucket_end=False ):
     """
         Description: 
           a function to downlaod all images  of a given date range 
@@ -577,32 +1281,58 @@ class download_s2_images(object):
           @ self:
           @ types :  type of images to be downloaded
           @ mask : when True the cloud mask image is downloaded
+          @ image_intersect : minimum fraction of the AOI covered by the scenes of a date (see img_intersection)
           @ next_date : define the next image to used to the collection when a mosaic / median method will be applied
+          @ change_reference, change_threshold, change_uint8 : parameters of the change products (see getChange_task)
+          @ plan : when True nothing is created and the plan of the run is returned (see plan)
+          @ lazy_html : when True (with export_image) the map is written with export_tiles_to_html
+          @ bucket_end : when set, only the dates before bucket_end are exported (the collection still goes
+            to end_date, so that the next_date buckets of the last dates are complete : shards of the CLI)
         Returns:
           -  image 
     """
+    if plan != False:
+      return self.plan(types, mask=mask, image_intersect=image_intersect, export_image=export_image, next_date=next_date,
+                       change_threshold=change_threshold, change_uint8=change_uint8)
+
+    self.saved_exports = 0
+    product = 'viz:' + str(types) if export_image != False else self.getTask_product(types)
+    transform = str([mask_water, image_intersect, change_reference, change_threshold, change_uint8])
+
     # Mask pixels
     if mask == False:
       collection  = self.collectByDate(self.getImages(), next_date=next_date)
-      image_list = collection.toList(collection.size())
+      # a single round trip for all the dates (collectByDate sets system:id to the date)
+      dates = collection.aggregate_array('system:id').getInfo()
+      image_list = collection.toList(len(dates))
 
-      img_size =  image_list .size().getInfo()
-      # img_size_s2cl = image_s2cloudless_list.size().getInfo()
-
-      print('size collection',image_list.size().getInfo())
+      print('size collection', len(dates))
       tasks =[]
+      if image_intersect!=False:
+        self.getFootprints()
       list_images = []
       list_image_names = []
 
-      for i in range(img_size):
-        single_img = self.api.ImageCollection([image_list .get(i), image_list .get(i)]).mosaic();
+      source = str(['COPERNICUS/S2_SR', self.boundaries_path, self.cloud_percentage, self.function])
+      requests = [{'index': i, 'start': d, 'end': self.add_days(d, next_date), 'source': source, 'transform': transform, 'product': product}
+                  for i, d in enumerate(dates) if bucket_end == False or d < bucket_end]
+      if export_image != False or 'cloud' not in types:
+        requests = self.dedupe_requests(requests, dates)
+
+      for request in requests:
+        i = request['index']
+        single_img = self.api.Image(image_list.get(i))
 
-        date =  self.api.Image(image_list.get(i)).date().format("YYYY-MM-dd").getInfo()
+        date =  dates[i]
         image_name = str(date) + '_' + str(date) +'plus'+str(next_date)
 
 
         if image_intersect!=False:
-          single_img = self.img_intersection(image_intersect, single_img)
+          single_img, end_date = self.img_intersection(image_intersect, single_img, str(date), self.add_days(str(date), next_date), mask=mask,
+                                                       snow_probability=snow_probability, cloud_probability=cloud_probability)
+          if single_img is None:
+            continue
+          image_name = str(date) + '_' + end_date
 
         # if mask_water == False :
         #   tasks.append (self.call_task(types, image_name, single_img ))
@@ -613,7 +1343,7 @@ class download_s2_images(object):
 #----------------------------------------------
         #=dON T EXPORTIMAGES
         if (export_image == False and 'cloud' not in types):
-          tasks.append (self.call_task(types, image_name, single_img ))
+          tasks.append (self.call_task(types, image_name, single_img, change_reference=change_reference, change_threshold=change_threshold, change_uint8=change_uint8 ))
 
         # visualized_im = ''
         if (export_image!=False):
@@ -624,31 +1354,22 @@ class download_s2_images(object):
 
       if "cloud" in types:
             # get s2cloudless images
-            error = False
-            try:
-              collection_s2cloudless =self.collectByDate(self.gets2cloudless(), next_date=next_date,)
-              image_lists2cloudless = collection_s2cloudless.toList(collection_s2cloudless.size())
-            except:
-              error = True
+            collection_s2cloudless =self.collectByDate(self.gets2cloudless(), next_date=next_date,)
+            cloud_dates = collection_s2cloudless.aggregate_array('system:id').getInfo()
+            if len(cloud_dates) == 0:
               print('No S2 cloudless layer available')
-            #print('error', error)
-            image_s2cloudless_list = collection_s2cloudless.toList(
-                    collection_s2cloudless.size()
-                )
-            print('size collection cloud ',image_s2cloudless_list.size().getInfo())
-
-            img_size_s2cl = image_s2cloudless_list.size().getInfo()
-            for i in range(img_size_s2cl):
-                single_img = self.api.ImageCollection(
-                    [image_s2cloudless_list.get(i), image_s2cloudless_list.get(i)]
-                ).mosaic()
-
-                date_cloudy = (
-                    self.api.Image(image_s2cloudless_list.get(i))
-                    .date()
-                    .format("YYYY-MM-dd")
-                    .getInfo()
-                )
+            image_s2cloudless_list = collection_s2cloudless.toList(len(cloud_dates))
+            print('size collection cloud ', len(cloud_dates))
+
+            cloud_source = str(['COPERNICUS/S2_CLOUD_PROBABILITY', self.boundaries_path, self.function])
+            cloud_requests = self.dedupe_requests([{'index': i, 'start': d, 'end': self.add_days(d, next_date), 'source': cloud_source,
+                                                    'transform': '', 'product': 'cloud'} for i, d in enumerate(cloud_dates)
+                                                   if bucket_end == False or d < bucket_end], cloud_dates)
+            for request in cloud_requests:
+                i = request['index']
+                single_img = self.api.Image(image_s2cloudless_list.get(i))
+
+                date_cloudy = cloud_dates[i]
 
                 image_name_cloudy = str(date_cloudy) + '_' + str(date_cloudy) +'plus'+str(next_date)
                 # if "cloud" in types:
@@ -666,7 +1387,10 @@ class download_s2_images(object):
       if (export_image!=False):
         # centerpoint  = [-16,16.3, 9.5]
         # list_images = [image, image]
-        res = self.export_geemap_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
+        if lazy_html != False:
+          res = self.export_tiles_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
+        else:
+          res = self.export_geemap_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
         return res
     #=================================================================================
 
@@ -674,31 +1398,41 @@ class download_s2_images(object):
 
     
       collection  = self.collectByDate(self.getMask_images( snow_probability=snow_probability,cloud_probability = snow_probability), next_date=next_date)
-      # get s2cloudless images
+      # a single round trip for all the dates (collectByDate sets system:id to the date)
+      dates = collection.aggregate_array('system:id').getInfo()
+      image_list = collection.toList(len(dates))
 
-      image_list = collection.toList(collection.size())
-      img_size =  image_list .size().getInfo()
-
-      print('size collection mask',image_list.size().getInfo())
+      print('size collection mask', len(dates))
       tasks =[]
+      if image_intersect!=False:
+        self.getFootprints()
 
       list_images = []
       list_image_names = []
 
-      for i in range(img_size):
-        single_img = self.api.ImageCollection([image_list .get(i), image_list .get(i)]).mosaic();
-        date =  self.api.Image(image_list.get(i)).date().format("YYYY-MM-dd").getInfo()
+      source = str(['COPERNICUS/S2_SR', self.boundaries_path, self.cloud_percentage, self.function, 'mask', snow_probability])
+      requests = self.dedupe_requests([{'index': i, 'start': d, 'end': self.add_days(d, next_date), 'source': source, 'transform': transform,
+                                        'product': product} for i, d in enumerate(dates) if bucket_end == False or d < bucket_end], dates)
+
+      for request in requests:
+        i = request['index']
+        single_img = self.api.Image(image_list.get(i))
+        date =  dates[i]
         image_name = str(date) + '_' + str(date) +'plus'+str(next_date)
 
         if image_intersect!=False:
-          single_img = self.img_intersection(image_intersect, single_img)
+          single_img, end_date = self.img_intersection(image_intersect, single_img, str(date), self.add_days(str(date), next_date), mask=mask,
+                                                       snow_probability=snow_probability, cloud_probability=cloud_probability)
+          if single_img is None:
+            continue
+          image_name = str(date) + '_' + end_date
 
         if mask_water != False :
           single_img  = self.mask_permanent_water( single_img , date_range_ =[mask_water[0] ,mask_water[1]] )
           
 
         if (export_image == False):
-          tasks.append (self.call_task(types, image_name, single_img ))
+          tasks.append (self.call_task(types, image_name, single_img, change_reference=change_reference, change_threshold=change_threshold, change_uint8=change_uint8 ))
 
         # visualized_im = ''
         if (export_image!=False): 
@@ -717,12 +1451,65 @@ class download_s2_images(object):
       if (export_image!=False):
         # centerpoint  = [-16,16.3, 9.5]
         # list_images = [image, image]
-        res = self.export_geemap_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
+        if lazy_html != False:
+          res = self.export_tiles_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
+        else:
+          res = self.export_geemap_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
         return res
       # return tasks
 
 
 
+  #================================================================================================
+  #  EXPORT REQUESTS DEDUPLICATION
+  #================================================================================================
+  def dedupe_requests(self, requests, acquisition_dates):
+    """
+        Description:
+          per-run planner of the export requests. Every request (source, window, transform, product) is
+          canonicalized by replacing its window with the set of acquisitions it contains, then the exact
+          duplicates and the windows that contain the same acquisitions (e.g. sliding windows) are removed
+          before any task is created. The windows with different acquisitions are all kept
+        Args:
+          @ self:
+          @ requests : list of dictionaries with source, start, end, transform and product
+          @ acquisition_dates : acquisition dates (YYYY-MM-DD) of the source
+        Returns:
+          -  the requests kept (the first of each group of identical requests)
+    """
+    from bisect import bisect_left
+
+    acquisitions = sorted(acquisition_dates)
+    kept = []
+    seen = set()
+    for request in requests:
+      content = tuple(acquisitions[bisect_left(acquisitions, request['start']):bisect_left(acquisitions, request['end'])])
+      key = (request['source'], content, request['transform'], request['product'])
+      if key in seen:
+        continue
+      seen.add(key)
+      kept.append(request)
+
+    saved = len(requests) - len(kept)
+    self.saved_exports += saved
+    print('export requests', len(requests), 'exports', len(kept), 'saved', saved)
+    return kept
+
+
+  def dedupe_windows(self, windows, acquisition_dates, source, transform, product):
+    """
+        Description:
+          dedupe_requests for a list of (start_date, end_date) windows
+        Args:
+          @ self:
+          @ windows : list of (start_date, end_date)
+          @ acquisition_dates, source, transform, product : see dedupe_requests
+        Returns:
+          -  the windows kept
+    """
+    requests = [{'start': start, 'end': end, 'source': source, 'transform': transform, 'product': product} for start, end in windows]
+    return [(request['start'], request['end']) for request in self.dedupe_requests(requests, acquisition_dates)]
+
   #================================================================================================
   #
   #================================================================================================
@@ -746,31 +1533,92 @@ class download_s2_images(object):
           Given a date range [start,end], the function  break it up into N contiguous
           sub-intervals distant from a value
       '''
-      from datetime import datetime
-      start_list =[]
-      
-      start = datetime.strptime(start,"%Y-%m-%d")
-      start_list.append(start)
-      end = datetime.strptime(end,"%Y-%m-%d")
-      j=0
-      i = start
-      yield start.strftime("%Y-%m-%d")
-      while i <= end :
+      import numpy as np
+      start = np.datetime64(start, 'D')
+      n_dates = (np.datetime64(end, 'D') - start).astype(int) // distance + 2
+      for day in (start + np.arange(n_dates) * distance).astype(str):
+        yield str(day)
 
-          # print(j)
-          # print(start_list[j] )
-          result = (start_list[j] + timedelta(days=distance,)).strftime("%Y-%m-%d")
-          print(datetime.strptime(result,"%Y-%m-%d"))
-          yield result
-          start_list.append(  datetime.strptime( (start_list[j] + timedelta(days=distance,)).strftime("%Y-%m-%d")  ,"%Y-%m-%d")     )
-          i = datetime.strptime(result,"%Y-%m-%d")
-          j=j+1
+
+  def getAcquisition_dates(self, collection):
+    """
+      Description:
+        distinct acquisition dates of a collection, in a single round trip
+      Args:
+        @ self:
+        @ collection : image collection
+      Returns:
+        - sorted list of dates (YYYY-MM-DD)
+    """
+    def datesDriver(t):
+      return self.api.Date(t).format("YYYY-MM-dd")
+    return collection.aggregate_array('system:time_start').map(datesDriver).distinct().sort().getInfo()
+
+
+  @staticmethod
+  def plan_windows(start, end, mode='fixed', length=5, step=False, acquisition_dates=None, anchor=False):
+    """
+      Description:
+        plan the date windows of a (multi-year) date range in a single vectorized call (numpy datetime64)
+      Args:
+        @ start, end : date range (YYYY-MM-DD, end excluded as in the GEE date filters)
+        @ mode :
+            fixed   : contiguous windows of length days
+            sliding : windows of length days every step days (overlapping when step < length)
+            month   : calendar months
+            dekad   : calendar dekads (1-10, 11-20, 21-end of the month)
+            orbit   : windows of length days (the revisit) centred on the acquisitions of the orbit of anchor
+        @ length : length of the windows (days)
+        @ step : distance between 2 windows for the sliding mode (default length)
+        @ acquisition_dates : when given, the windows that contain no acquisition are dropped
+        @ anchor : date on which the fixed / sliding / orbit windows are aligned
+          (default : first acquisition date, or start)
+      Returns:
+        - list of (start_date, end_date) windows, end_date excluded
+    """
+    import numpy as np
+
+    start = np.datetime64(start, 'D')
+    end = np.datetime64(end, 'D')
+    acquisitions = np.sort(np.array(acquisition_dates if acquisition_dates is not None else [], dtype='datetime64[D]'))
+
+    if mode in ['fixed', 'sliding', 'orbit']:
+      if anchor == False:
+        anchor = acquisitions[0] if len(acquisitions) > 0 else start
+      anchor = np.datetime64(anchor, 'D')
+      step = length if (step == False or mode != 'sliding') else step
+      if mode == 'orbit':
+        anchor = anchor - length // 2
+      first = (start - anchor).astype(int) // step
+      last = -(-(end - anchor).astype(int) // step)
+      starts = anchor + np.arange(first, last) * step
+      ends = starts + length
+    elif mode in ['month', 'dekad']:
+      months = np.arange(start.astype('datetime64[M]'), (end - 1).astype('datetime64[M]') + 1)
+      month_starts = months.astype('datetime64[D]')
+      month_ends = (months + 1).astype('datetime64[D]')
+      if mode == 'month':
+        starts, ends = month_starts, month_ends
+      else:
+        starts = np.column_stack([month_starts, month_starts + 10, month_starts + 20]).ravel()
+        ends = np.column_stack([month_starts + 10, month_starts + 20, month_ends]).ravel()
+    else:
+      raise ValueError('unknown window mode ' + str(mode))
+
+    # clip the windows to the date range
+    starts = np.maximum(starts, start)
+    ends = np.minimum(ends, end)
+    keep = starts < ends
+    if acquisition_dates is not None:
+      keep &= np.searchsorted(acquisitions, ends) > np.searchsorted(acquisitions, starts)
+    starts, ends = starts[keep], ends[keep]
+    return list(zip(starts.astype(str).tolist(), ends.astype(str).tolist()))
 
 
   #================================================================================================
   #
   #================================================================================================
-  def getAll_images_by_interval(self, types=['mndwi','rgb', 'cloud'], mask=False, mask_water=False, export_image = False, image_intersect=False, interval =5):
+  def getAll_images_by_interval(self, types=['mndwi','rgb', 'cloud'], mask=False, mask_water=False, export_image = False, image_intersect=False, interval =5, change_reference=False, change_threshold=False, change_uint8=False, plan=False, lazy_html=False, window_mode='fixed', window_step=False, window_anchor=False):
     """
         Description: 
           a function to downlaod images by setting up the interval range based on the date range   
@@ -778,47 +1626,48 @@ class download_s2_images(object):
           @ self:
           @ types :  type of images to be downloaded
           @ mask : when True the cloud mask image is downloaded
+          @ image_intersect : minimum fraction of the AOI covered by the scenes of an interval (see img_intersection)
           @ interval : distance between 2 dates. The default value is 5 as a single Sentinel-2 satellite
            is able to map the global landmasses once every 5 days
+          @ window_mode, window_step : how the windows are planned (see plan_windows)
+          @ window_anchor : date on which the windows are aligned (see the anchor of plan_windows)
+          @ change_reference, change_threshold, change_uint8 : parameters of the change products (see getChange_task)
+          @ plan : when True nothing is created and the plan of the run is returned (see plan)
+          @ lazy_html : when True (with export_image) the map is written with export_tiles_to_html
         Returns:
           -  an image 
     """
+    if plan != False:
+      return self.plan(types, mask=mask, image_intersect=image_intersect, export_image=export_image, interval=interval,
+                       window_mode=window_mode, window_step=window_step, window_anchor=window_anchor, change_threshold=change_threshold,
+                       change_uint8=change_uint8)
+
+    self.saved_exports = 0
+    product = 'viz:' + str(types) if export_image != False else self.getTask_product(types)
+    transform = str([mask_water, image_intersect, change_reference, change_threshold, change_uint8])
+
     # global  date_range_list
     if mask ==False:
-      try:
-        collection  = self.collectByDate(self.getImages())
-        image_list = collection.toList(collection.size())
-      except:
+      # the windows without acquisition are dropped before any expression is built
+      acquisition_dates = self.getAcquisition_dates(self.getImages())
+      print('size collection', len(acquisition_dates))
+      if len(acquisition_dates) == 0:
         print('No image available - interval ')
-      
-      
-      date1 =  self.api.Image(image_list.get(0)).date().format("YYYY-MM-dd").getInfo()
-      datei = self.from_date_to_doy(date1)
-
-      list_interval = [ self.from_date_to_doy(date1) ]
-      cpt=1
-
-      while datei < self.from_date_to_doy(self.end_date) + interval :
-          datei = datei + interval
-          list_interval.append( datei )
-
-      # date_range_list = list(self.date_range(self.start_date, self.end_date, list_interval))[:-1]
-      date_range_list = list(self.date_range ( str(date1) , self.end_date, interval) )
-
-
-      img_size =  image_list .size().getInfo()
-    
-      print('size collection',image_list.size().getInfo())
+      windows = self.plan_windows(self.start_date, self.end_date, mode=window_mode, length=interval, step=window_step, acquisition_dates=acquisition_dates,
+                                  anchor=window_anchor)
 
       tasks =[]
+      if image_intersect!=False:
+        self.getFootprints()
       list_images=[] 
       list_image_names = []
 
-      print('date_range_list', date_range_list)
+      print('windows', windows)
+      source = str(['COPERNICUS/S2_SR', self.boundaries_path, self.cloud_percentage, self.function])
+      if export_image != False or 'cloud' not in types:
+        windows = self.dedupe_windows(windows, acquisition_dates, source, transform, product)
 
-      for i in range (len(date_range_list) - 1 ):
-        start_date = date_range_list [i]
-        end_date =  date_range_list [i+1]
+      for start_date, end_date in windows:
 
         if self.function == 'mosaic':
           single_img = self.setImage(start_date, end_date).mosaic()
@@ -829,14 +1678,16 @@ class download_s2_images(object):
         image_name =date
 
         if image_intersect!=False:
-          single_img = self.img_intersection(image_intersect, single_img)
+          single_img, end_date = self.img_intersection(image_intersect, single_img, start_date, end_date, merge=False)
+          if single_img is None:
+            continue
           
         if mask_water != False :
           single_img  = self.mask_permanent_water( single_img , date_range_ =[mask_water[0] ,mask_water[1]] )
           
         #=dON T EXPORTIMAGES
         if (export_image == False and 'cloud' not in types):
-          tasks.append (self.call_task(types, image_name, single_img ))
+          tasks.append (self.call_task(types, image_name, single_img, change_reference=change_reference, change_threshold=change_threshold, change_uint8=change_uint8 ))
 
         # visualized_im = ''
         if (export_image!=False):
@@ -847,52 +1698,31 @@ class download_s2_images(object):
 
 
       if "cloud" in types:
-            try:
-              collection_s2cloudless = self.gets2cloudless()
-              image_lists2cloudless = collection_s2cloudless.toList(collection_s2cloudless.size())
-            except:
+            collection_s2cloudless = self.gets2cloudless()
+            cloud_dates = self.getAcquisition_dates(collection_s2cloudless)
+            if len(cloud_dates) == 0:
               print('no S2cloudless images')
+            cloud_windows = self.plan_windows(self.start_date, self.end_date, mode=window_mode, length=interval, step=window_step, acquisition_dates=cloud_dates,
+                                            anchor=window_anchor)
+            cloud_source = str(['COPERNICUS/S2_CLOUD_PROBABILITY', self.boundaries_path, self.function])
+            cloud_windows = self.dedupe_windows(cloud_windows, cloud_dates, cloud_source, '', 'cloud')
 
-            image_s2cloudless_list = collection_s2cloudless.toList(
-                          collection_s2cloudless.size()
-                      )
-
-            
-            date1 =  self.api.Image( image_s2cloudless_list.get(0)).date().format("YYYY-MM-dd").getInfo()
-            datei = self.from_date_to_doy(date1)
-            list_interval=[ self.from_date_to_doy(date1) ]
-            cpt=1
-            while datei < self.from_date_to_doy(self.end_date) + interval :
-                datei = datei + interval
-                list_interval.append( datei )
-                
-            
-            # print('No image available')
-              
-            img_size_s2cl = image_s2cloudless_list.size().getInfo()
-
-            date_range_list = list(self.date_range(self.start_date, self.end_date, list_interval))[:-1]
-
-            for i in range (len(date_range_list) - 1 ):
-              start_date = date_range_list [i]
-              end_date =  date_range_list [i+1]
-
+            for start_date, end_date in cloud_windows:
+              window_s2cloudless = collection_s2cloudless.filterDate(start_date, end_date)
               if self.function == 'mosaic':
-                single_img = self.setImage(start_date, end_date).mosaic()
+                single_img = window_s2cloudless.mosaic()
               elif self.function == 'median':
-                single_img = self.setImage( start_date, end_date).median()
+                single_img = window_s2cloudless.median()
 
+              date_cloudy = start_date + '_' +end_date 
 
-                date_cloudy = start_date + '_' +end_date 
+              # if "cloud" in types:
+              tasks.append(
+                      self.getS2cloudless_task(
+                          "cloud_" + str(date_cloudy), single_img
+                      )
+                  )
 
-      
-                # if "cloud" in types:
-                tasks.append(
-                        self.getS2cloudless_task(
-                            "cloud_" + str(date_cloudy), single_img
-                        )
-                    )
-      
 
 
 
@@ -902,44 +1732,29 @@ class download_s2_images(object):
       if (export_image!=False):
         # centerpoint  = [-16,16.3, 9.5]
         # list_images = [image, image]
-        res = self.export_geemap_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
+        if lazy_html != False:
+          res = self.export_tiles_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
+        else:
+          res = self.export_geemap_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
         return res
     #=================================================================================
 
     else:  # GET IMAGES WITH MASK  PIXELS
 
-      collection  = self.collectByDate(self.getMask_images())
-      # get s2cloudless images
-      collection_s2cloudless =self.collectByDate(self.gets2cloudless())
-      image_list = collection.toList(collection.size())
-      img_size =  image_list .size().getInfo()
-      print('size collection',image_list.size().getInfo())
-    
-  
-      #try:
-      date1 =  self.api.Image(image_list.get(0)).date().format("YYYY-MM-dd").getInfo()
-      datei = self.from_date_to_doy(date1)
-      list_interval=[ self.from_date_to_doy(date1) ]
-      cpt=1
-      while datei < self.from_date_to_doy(self.end_date) + 1 :
-          datei = datei + interval
-          list_interval.append( datei )
-          
-      #except:
-        #print('No image available')
-        
+      acquisition_dates = self.getAcquisition_dates(self.getMask_images())
+      print('size collection', len(acquisition_dates))
+      windows = self.plan_windows(self.start_date, self.end_date, mode=window_mode, length=interval, step=window_step, acquisition_dates=acquisition_dates,
+                                  anchor=window_anchor)
+      source = str(['COPERNICUS/S2_SR', self.boundaries_path, self.cloud_percentage, self.function, 'mask'])
+      windows = self.dedupe_windows(windows, acquisition_dates, source, transform, product)
+
       tasks =[]
+      if image_intersect!=False:
+        self.getFootprints()
       list_images= [] 
       list_image_names = []
 
-      # date_range_list = list(self.date_range(self.start_date, self.end_date, list_interval))[:-1]
-
-      date_range_list = list(self.date_range ( str(date1) , self.end_date, interval) )
-
-
-      for i in range (len(date_range_list) - 1 ):
-        start_date = date_range_list [i]
-        end_date =  date_range_list [i+1]
+      for start_date, end_date in windows:
 
         if self.function == 'mosaic':
           single_img = self.setMask_images(start_date, end_date).mosaic()
@@ -951,13 +1766,15 @@ class download_s2_images(object):
         image_name =date
 
         if image_intersect!=False:
-          single_img = self.img_intersection(image_intersect, single_img)
+          single_img, end_date = self.img_intersection(image_intersect, single_img, start_date, end_date, merge=False)
+          if single_img is None:
+            continue
 
         if mask_water != False :
           single_img  = self.mask_permanent_water( single_img , date_range_ =[mask_water[0] ,mask_water[1]] )
 
         if (export_image == False):
-          tasks.append (self.call_task(types, image_name, single_img ))
+          tasks.append (self.call_task(types, image_name, single_img, change_reference=change_reference, change_threshold=change_threshold, change_uint8=change_uint8 ))
 
         # visualized_im = ''
         if (export_image!=False): 
@@ -976,6 +1793,1207 @@ class download_s2_images(object):
       if (export_image!=False):
         # centerpoint  = [-16,16.3, 9.5]
         # list_images = [image, image]
-        res = self.export_geemap_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
+        if lazy_html != False:
+          res = self.export_tiles_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
+        else:
+          res = self.export_geemap_to_html(list_images, list_image_names, self.folder, centerpoint = export_image)
         return res    
 
+
+  #================================================================================================
+  #  TIME-SERIES ZONAL STATISTICS
+  #================================================================================================
+  def getZonal_reducer(self, reducers=['mean', 'area'], percentiles=[10, 50, 90]):
+    """
+        Description:
+          build a single combined reducer from a list of reducer names
+        Args:
+          @ self:
+          @ reducers : list of [mean, median, min, max, stdDev, percentile, area]
+          @ percentiles : percentiles computed when 'percentile' is in reducers
+        Returns:
+          -  the combined reducer and the list of its output names
+    """
+    reducer = None
+    outputs = []
+    for name in reducers:
+      if name == 'area':
+        continue
+      if name == 'percentile':
+        single_reducer = self.api.Reducer.percentile(percentiles)
+        outputs += ['p' + str(p) for p in percentiles]
+      else:
+        single_reducer = getattr(self.api.Reducer, name)()
+        outputs.append(name)
+      reducer = single_reducer if reducer is None else reducer.combine(single_reducer, '', True)
+
+    # area above the threshold is the sum of the pixel areas of the '<index>_area' bands
+    if 'area' in reducers and 'sum' not in outputs:
+      reducer = self.api.Reducer.sum() if reducer is None else reducer.combine(self.api.Reducer.sum(), '', True)
+      outputs.append('sum')
+    return reducer, outputs
+
+
+  def getAll_statistics(self, types=['mndwi'], mask=False, mask_water=False, zones=False, reducers=['mean', 'area'], threshold=0,
+                        percentiles=[10, 50, 90], next_date=1, scale=10, tile_scale=1, export_table=False, file_format='CSV',
+                        output_file=False, snow_probability=5, cloud_probability=30):
+    """
+        Description:
+          compute a time series of zonal statistics of the indices instead of exporting one raster per date.
+          The index computation is mapped over the collection grouped by collectByDate and every date is
+          reduced over the zones in one server-side reduceRegions expression
+        Args:
+          @ self:
+          @ types : indices on which the statistics are computed [mndwi, ndwi, ndvi, swi]
+          @ mask : when True the cloud masked collection is used
+          @ mask_water : [start_date, end_date] used to mask the permanent water, False to disable
+          @ zones : False to reduce over the whole AOI, True to reduce over every polygon of the boundary
+            FeatureCollection, or the path of another FeatureCollection asset
+          @ reducers : list of [mean, median, min, max, stdDev, percentile, area]. 'area' is the area (m2)
+            of the pixels above threshold
+          @ threshold : threshold of the index used by the 'area' reducer
+          @ percentiles : percentiles computed when 'percentile' is in reducers
+          @ next_date : see collectByDate
+          @ scale : scale (m) of the reduction
+          @ export_table : when True (or a file name) an Export.table task is returned instead of the rows
+          @ file_format : format of the exported table (CSV, GeoJSON, SHP, ...)
+          @ output_file : local .csv or .parquet file in which the rows are written (getInfo mode only)
+        Returns:
+          -  a table task if export_table, else the list of rows (one dict per date and zone)
+    """
+    if mask == False:
+      collection = self.collectByDate(self.getImages(), next_date=next_date)
+    else:
+      collection = self.collectByDate(self.getMask_images(snow_probability=snow_probability, cloud_probability=cloud_probability), next_date=next_date)
+
+    if zones == False:
+      zones_fc = self.api.FeatureCollection([self.api.Feature(self.getGeometry())])
+    elif zones == True:
+      zones_fc = self.api.FeatureCollection(self.boundaries_path)
+    else:
+      zones_fc = self.api.FeatureCollection(zones)
+
+    index_types = [t for t in types if t in self.getIndices()]
+    reducer, outputs = self.getZonal_reducer(reducers, percentiles)
+
+    # reduceRegions names the outputs <output> for a single band image, <band> for a single output reducer
+    # and <band>_<output> otherwise
+    bands = index_types + ([t + '_area' for t in index_types] if 'area' in reducers else [])
+
+    def serverName(band, output):
+      if len(bands) == 1:
+        return output
+      return band if len(outputs) == 1 else band + '_' + output
+
+    renames = []
+    for band in bands:
+      for output in outputs:
+        server_name = serverName(band, output)
+        if band.endswith('_area') and output == 'sum':
+          renames.append((server_name, band))
+        elif not band.endswith('_area') and (output != 'sum' or 'sum' in reducers):
+          renames.append((server_name, band + '_' + output))
+    server_names = [serverName(band, output) for band in bands for output in outputs]
+    drop_names = [n for n in server_names if n not in [target for _, target in renames]]
+
+    def tableDriver(feature):
+      feature = self.api.Feature(feature)
+      for server_name, target_name in renames:
+        feature = feature.set(target_name, feature.get(server_name))
+      return feature.select(feature.propertyNames().removeAll(drop_names), None, False)
+
+    def statsDriver(image):
+      image = self.api.Image(image)
+      if mask_water != False:
+        image = self.mask_permanent_water(image, date_range_=[mask_water[0], mask_water[1]])
+
+      index = self.getIndex_image(index_types, image)
+      if 'area' in reducers:
+        water_area = index.gt(threshold).multiply(self.api.Image.pixelArea()).rename([t + '_area' for t in index_types])
+        index = index.addBands(water_area)
+
+      stats = index.reduceRegions(collection=zones_fc, reducer=reducer, scale=scale, tileScale=tile_scale)
+      return stats.map(lambda feature: tableDriver(feature).set('date', image.get('system:id')))
+
+    table = self.api.FeatureCollection(collection.map(statsDriver)).flatten()
+
+    if export_table != False:
+      table_name = export_table if isinstance(export_table, str) else '_'.join(['stats'] + index_types + [self.start_date, self.end_date])
+      task = self.api.batch.Export.table.toDrive(
+        **{
+                 'collection': table,
+                 'description': table_name,
+                 'folder': self.folder,
+                 'fileNamePrefix': table_name,
+                 'fileFormat': file_format,
+         }
+       )
+      return task
+
+    rows = [feature['properties'] for feature in table.getInfo()['features']]
+    if output_file != False:
+      if output_file.endswith('.parquet'):
+        import pandas as pd
+        try:
+          import pyarrow
+        except ImportError:
+          raise ImportError('writing a .parquet output_file needs pyarrow (pip install pyarrow), use a .csv file otherwise')
+        pd.DataFrame(rows).to_parquet(output_file)
+      else:
+        import csv
+        columns = sorted({key for row in rows for key in row})
+        with open(output_file, 'w', newline='') as f:
+          writer = csv.DictWriter(f, fieldnames=columns)
+          writer.writeheader()
+          writer.writerows(rows)
+    return rows
+
+  #================================================================================================
+  #  MULTI-TEMPORAL STACK EXPORT
+  #================================================================================================
+  def getAll_stack(self, types=['mndwi'], mask=False, mask_water=False, next_date=1, interval=False, stack_name='stack',
+                   max_bands=100, max_pixels=1e10, scale=10, snow_probability=5, cloud_probability=30):
+    """
+        Description:
+          export the indices of all the dates (or intervals) as the bands of a few multi-band images
+          instead of one task per date. The band names encode the date window (<index>_<start>_<end>)
+          and the stack is split automatically when the band or pixel budget is exceeded
+        Args:
+          @ self:
+          @ types : indices to stack [mndwi, ndwi, ndvi, swi]
+          @ mask : when True the cloud masked collection is used
+          @ mask_water : [start_date, end_date] used to mask the permanent water, False to disable
+          @ next_date : see collectByDate (used when interval is False)
+          @ interval : when set, the date range is split in windows of interval days as in getAll_images_by_interval
+          @ stack_name : prefix of the exported files
+          @ max_bands : maximum number of bands of a single stack
+          @ max_pixels : maximum number of pixels (bands x pixels) of a single stack
+          @ scale : export scale (m)
+        Returns:
+          -  list of tasks (one per stack)
+    """
+    index_types = [t for t in types if t in self.getIndices()]
+
+    if interval == False:
+      if mask == False:
+        collection = self.collectByDate(self.getImages(), next_date=next_date)
+      else:
+        collection = self.collectByDate(self.getMask_images(snow_probability=snow_probability, cloud_probability=cloud_probability), next_date=next_date)
+      # a single round trip for all the dates
+      dates = collection.aggregate_array('system:id').getInfo()
+      windows = [(d, (datetime.strptime(d, "%Y-%m-%d") + timedelta(days=next_date)).strftime("%Y-%m-%d")) for d in dates]
+      image_list = collection.toList(len(dates))
+    else:
+      source = self.getImages() if mask == False else self.getMask_images(snow_probability=snow_probability, cloud_probability=cloud_probability)
+      windows = self.plan_windows(self.start_date, self.end_date, length=interval, acquisition_dates=self.getAcquisition_dates(source))
+      images = []
+      for start_date, end_date in windows:
+        if mask == False:
+          window_col = self.setImage(start_date, end_date)
+        else:
+          window_col = self.setMask_images(start_date, end_date, snow_probability=snow_probability, cloud_probability=cloud_probability)
+        images.append(window_col.mosaic() if self.function == 'mosaic' else window_col.median())
+      image_list = self.api.List(images)
+
+    def stackDriver(image):
+      image = self.api.Image(image)
+      if mask_water != False:
+        image = self.mask_permanent_water(image, date_range_=[mask_water[0], mask_water[1]])
+      return self.getIndex_image(index_types, image).toFloat()
+
+    # split the windows so that every stack stays within the band and pixel budgets
+    pixels_per_band = self.getGeometry().bounds().area(1).getInfo() / (scale * scale)
+    windows_per_stack = int(min(max_bands, max_pixels / max(pixels_per_band, 1)) // max(len(index_types), 1))
+    windows_per_stack = max(windows_per_stack, 1)
+
+    tasks = []
+    for first in range(0, len(windows), windows_per_stack):
+      stack_windows = windows[first:first + windows_per_stack]
+      band_names = [t + '_' + start.replace('-', '') + '_' + end.replace('-', '') for start, end in stack_windows for t in index_types]
+      stack = self.api.ImageCollection(image_list.slice(first, first + len(stack_windows)).map(stackDriver)).toBands().rename(band_names)
+
+      filename = stack_name + '_' + '_'.join(index_types) + '_' + stack_windows[0][0] + '_' + stack_windows[-1][1]
+      self.write_stack_manifest(filename, band_names)
+      tasks.append(self.getTask(stack.clip(self.getGeometry()), filename))
+    return tasks
+
+
+  def write_stack_manifest(self, filename, band_names):
+    """
+        Description:
+          save the band names of an exported stack next to the local folder, so that read_stack can
+          index the bands by date even when the GeoTIFF has no band descriptions
+        Args:
+          @ self:
+          @ filename : name of the exported stack
+          @ band_names : names of the bands of the stack
+        Returns:
+          -  path of the manifest
+    """
+    import json
+    manifest = os.path.join(self.folder, filename + '_bands.json')
+    with open(manifest, 'w') as f:
+      json.dump(band_names, f)
+    return manifest
+
+
+  def read_stack(self, stack_files):
+    """
+        Description:
+          read one or several exported stacks as a time indexed array
+        Args:
+          @ self:
+          @ stack_files : path (or list of paths) of the downloaded stack GeoTIFFs
+        Returns:
+          -  windows : list of (start_date, end_date) of the time axis
+          -  index_types : list of the indices of the second axis
+          -  array : numpy array of shape (time, index, rows, cols)
+    """
+    import json
+    import numpy as np
+    import rasterio
+
+    if isinstance(stack_files, str):
+      stack_files = [stack_files]
+
+    layers = {}
+    index_types = []
+    for stack_file in stack_files:
+      with rasterio.open(stack_file) as src:
+        band_names = list(src.descriptions)
+        if None in band_names:
+          manifest = os.path.join(self.folder, os.path.splitext(os.path.basename(stack_file))[0] + '_bands.json')
+          with open(manifest) as f:
+            band_names = json.load(f)
+        data = src.read()
+
+      for band, band_name in enumerate(band_names):
+        index, start, end = band_name.rsplit('_', 2)
+        window = (start[:4] + '-' + start[4:6] + '-' + start[6:], end[:4] + '-' + end[4:6] + '-' + end[6:])
+        if index not in index_types:
+          index_types.append(index)
+        layers[(window, index)] = data[band]
+
+    windows = sorted({window for window, _ in layers})
+    array = np.stack([np.stack([layers[(window, index)] for index in index_types]) for window in windows])
+    return windows, index_types, array
+
+  #================================================================================================
+  #  DRY-RUN PLANNER
+  #================================================================================================
+  def plan(self, types=['mndwi'], mask=False, image_intersect=False, export_image=False, next_date=1, interval=False, scale=10,
+           window_mode='fixed', window_step=False, window_anchor=False, change_threshold=False, change_uint8=False, output_file=False):
+    """
+        Description:
+          describe what getAll_images (interval False) or getAll_images_by_interval (interval set) would
+          create, without creating any task: date windows, task names, estimated pixels and bytes of every
+          export, and the number of getInfo round trips of the run. The acquisition dates and the AOI
+          area are fetched in a single getInfo. With image_intersect, the windows are skipped or merged
+          as in the run (see getIntersection_window)
+        Args:
+          @ self:
+          @ types, mask, image_intersect, export_image, next_date : see getAll_images
+          @ interval, window_mode, window_step, window_anchor : see getAll_images_by_interval
+          @ scale : export scale (m)
+          @ change_threshold, change_uint8 : see getChange_task
+          @ output_file : when set, the plan is also written to this JSON file
+        Returns:
+          -  the plan (dictionary)
+    """
+    def datesDriver(t):
+      return self.api.Date(t).format("YYYY-MM-dd")
+
+    info = self.api.Dictionary({
+        'area': self.getGeometry().bounds().area(1),
+        'dates': self.getImages().aggregate_array('system:time_start').map(datesDriver).distinct().sort(),
+        'cloud_dates': self.gets2cloudless().aggregate_array('system:time_start').map(datesDriver).distinct().sort(),
+      }).getInfo()
+    pixels = int(info['area'] / (scale * scale))
+
+    # dtype and number of bands of the exported products
+    product_specs = {}
+    for name, spec in self.products.items():
+      product_specs[name] = (spec['dtype'], len(spec['bands']) if spec['math'] in ['visualize', 'select'] else 1)
+    # the change masks (change_threshold set) are uint8 images with the classes 0, 1, 2
+    change_mask = change_threshold is not False and change_threshold is not None
+    for index in self.getIndices():
+      product_specs[index + '_change'] = ('uint8' if change_uint8 or change_mask else 'float32', 1)
+
+    def windows_of(dates, product_name):
+      if len(dates) == 0:
+        return []
+      if interval == False:
+        windows = [(d, self.add_days(d, next_date)) for d in dates]
+      else:
+        windows = self.plan_windows(self.start_date, self.end_date, mode=window_mode, length=interval, step=window_step, acquisition_dates=dates,
+                                         anchor=window_anchor)
+      # the same deduplication as the run
+      windows = self.dedupe_windows(windows, dates, '', '', product_name)
+      if interval == False:
+        return [(start, end, start + '_' + start + 'plus' + str(next_date)) for start, end in windows]
+      return [(start, end, start + '_' + end) for start, end in windows]
+
+    product = self.getTask_product(types)
+    with_cloud = 'cloud' in types and mask == False
+    self.saved_exports = 0
+    exports = []
+    if product is not None and not with_cloud:
+      exports += [(product, w) for w in windows_of(info['dates'], product)]
+    if with_cloud:
+      exports += [('cloud', w) for w in windows_of(info['cloud_dates'], 'cloud')]
+
+    if image_intersect != False:
+      self.getFootprints()
+
+    windows = []
+    for product_name, (start, end, name) in exports:
+      coverage = None
+      if image_intersect != False and product_name != 'cloud':
+        # the same skip / merge decision as img_intersection (the interval mode only skips)
+        end, coverage = self.getIntersection_window(image_intersect, start, end, merge=interval == False)
+        if end is None:
+          continue
+        if interval == False:
+          name = start + '_' + end
+      dtype, bands = product_specs[product_name]
+      window = {
+          'product': product_name,
+          'start_date': start,
+          'end_date': end,
+          'task_name': product_name + '_' + name,
+          'dtype': dtype,
+          'bands': bands,
+          'pixels': pixels,
+          'bytes': pixels * bands * self.dtypes[dtype][1],
+        }
+      if coverage is not None:
+        window['coverage'] = coverage
+      windows.append(window)
+
+    # getInfo round trips of getAll_images / getAll_images_by_interval
+    getinfo_calls = 1
+    if with_cloud:
+      getinfo_calls += 1
+    if image_intersect != False:
+      getinfo_calls += 1
+    if export_image != False:
+      # one map id per layer (at most : lazy_html reuses the cached map ids) and the contour of the map
+      # (a map id, or the getInfo of the AOI with lazy_html)
+      getinfo_calls += len([w for w in windows if w['product'] != 'cloud']) + 1
+    elif self.result_cache != False and len(windows) > 0:
+      # states of the tasks of the result cache (see getCached_result)
+      getinfo_calls += 1
+
+    plan = {
+        'mode': 'date' if interval == False else 'interval',
+        'scale': scale,
+        'export_image': export_image != False,
+        'n_tasks': 0 if export_image != False else len(windows),
+        'pixels_per_export': pixels,
+        'total_pixels': sum(w['pixels'] for w in windows),
+        'total_bytes': sum(w['bytes'] for w in windows),
+        'getinfo_calls': getinfo_calls,
+        'saved_exports': self.saved_exports,
+        'windows': windows,
+      }
+
+    if output_file != False:
+      import json
+      with open(output_file, 'w') as f:
+        json.dump(plan, f, indent=2)
+    return plan
+
+  #================================================================================================
+  #  LOCAL POST-PROCESSING OF THE EXPORTED INDICES
+  #================================================================================================
+  def postprocess_images(self, index_files, threshold='otsu', permanent_water=False, zones=False, zone_field=False,
+                         output_folder=False, max_workers=None):
+    """
+      Description:
+        threshold the downloaded index GeoTIFFs (getMNDWI_task, getNDWI_task, ...) into water masks and
+        compute the water area of every zone. The files are streamed by their internal blocks in a
+        process pool (see postprocess_file), so the memory stays bounded whatever the size of the scene
+      Args:
+        @ self:
+        @ index_files : list of the downloaded index GeoTIFFs
+        @ threshold : fixed threshold of the index, or 'otsu'
+        @ permanent_water : raster of the permanent water (pixels > 0 are removed from the water mask)
+        @ zones : vector file of the polygons on which the water area is aggregated, False for the whole scene
+        @ zone_field : attribute of zones used as zone id (default : row index)
+        @ output_folder : folder of the COG water masks (default : folder/WATER_MASKS)
+        @ max_workers : number of processes (default : number of cores)
+      Returns:
+        - list of rows (file, zone, threshold, water area in m2)
+    """
+    if output_folder == False:
+      output_folder = os.path.join(os.path.expanduser(self.folder), 'WATER_MASKS')
+    if not os.path.exists(output_folder):
+      os.makedirs(output_folder)
+
+    rows = []
+    for index_file in index_files:
+      name = os.path.splitext(os.path.basename(index_file))[0]
+      result = postprocess_file(index_file, os.path.join(output_folder, name + '_water.tif'), threshold=threshold,
+                                permanent_water=permanent_water, zones=zones, zone_field=zone_field, max_workers=max_workers)
+      for zone, area in result['areas'].items():
+        rows.append({'file': name, 'zone': zone, 'threshold': result['threshold'], 'water_area': area})
+    return rows
+
+  #================================================================================================
+  #  NEAR-REAL-TIME MONITORING
+  #================================================================================================
+  def load_monitor_state(self, state_file):
+    """
+      Description:
+        load the state of the monitoring (high-water marks, pending buckets, queued, submitted and failed products)
+      Args:
+        @ self:
+        @ state_file : JSON file of the state
+      Returns:
+        - the state dictionary
+    """
+    import json
+
+    state = {'high_water_marks': {}, 'pending': {}, 'queue': [], 'submitted': {}, 'failed': []}
+    if os.path.exists(state_file):
+      with open(state_file) as f:
+        state.update(json.load(f))
+    return state
+
+
+  def save_monitor_state(self, state, state_file):
+    """
+      Description:
+        save the state of the monitoring. The file is replaced atomically so that a crash never leaves
+        a truncated state
+      Args:
+        @ self:
+        @ state : the state dictionary
+        @ state_file : JSON file of the state
+      Returns:
+        - path of the state file
+    """
+    import json
+
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+      json.dump(state, f, indent=1)
+    os.replace(tmp_file, state_file)
+    return state_file
+
+
+  def poll_acquisitions(self, aois, state, lookback_days=3):
+    """
+      Description:
+        cheap metadata query of the new COPERNICUS/S2_SR and COPERNICUS/S2_CLOUD_PROBABILITY acquisitions
+        of all the AOIs, newer than their high-water marks (minus lookback_days for the late ingestions),
+        in a single getInfo
+      Args:
+        @ self:
+        @ aois : list of boundary assets
+        @ state : the monitoring state
+        @ lookback_days : the acquisitions ingested late are searched this number of days before the mark
+      Returns:
+        - dictionary {aoi : {collection : list of acquisition times (ms)}}
+    """
+    # the acquisition times are UTC
+    start_ms = int(datetime.strptime(self.start_date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+    query = {}
+    for i, aoi in enumerate(aois):
+      geometry = self.api.FeatureCollection(aoi).geometry()
+      for collection in ['COPERNICUS/S2_SR', 'COPERNICUS/S2_CLOUD_PROBABILITY']:
+        mark = state['high_water_marks'].get(aoi + '|' + collection, start_ms)
+        images = self.api.ImageCollection(collection).filterBounds(geometry).filter(
+          self.api.Filter.gt('system:time_start', mark - lookback_days * 86400000))
+        if collection == 'COPERNICUS/S2_SR':
+          images = images.filter(self.api.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', self.cloud_percentage))
+        query[str(i) + '|' + collection] = images.aggregate_array('system:time_start')
+
+    info = self.api.Dictionary(query).getInfo()
+    acquisitions = {}
+    for key, times in info.items():
+      i, collection = key.split('|')
+      acquisitions.setdefault(aois[int(i)], {})[collection] = times
+    return acquisitions
+
+
+  def monitor_once(self, types=['mndwi'], aois=False, state_file=False, next_date=1, mask=False, mask_water=False,
+                   max_running=5, settle_minutes=30, lookback_days=3, max_attempts=3, change_reference=False,
+                   change_threshold=False, change_uint8=False):
+    """
+      Description:
+        one step of the monitoring : poll the new acquisitions, coalesce them in next_date buckets
+        (as collectByDate), queue the products of the buckets settled for settle_minutes and submit the
+        queue with at most max_running tasks running at the same time. The state is saved durably, after
+        every task started. A product whose task can not be created or started goes back to the end of
+        the queue, and to the failed products after max_attempts
+      Args:
+        @ self:
+        @ types : type of images to be downloaded (see call_task, 'cloud' for the S2cloudless layer)
+        @ aois : list of boundary assets (default : the boundary of the object)
+        @ state_file : JSON file of the state (default : folder/monitor_state.json)
+        @ next_date, mask, mask_water : see getAll_images
+        @ max_running : maximum number of tasks running at the same time
+        @ settle_minutes : time to wait after the first acquisition of a bucket, so that all the tiles
+          of a pass are exported together
+        @ lookback_days : see poll_acquisitions
+        @ max_attempts : number of attempts of a product before it is moved to the failed products
+        @ change_reference, change_threshold, change_uint8 : parameters of the change products (see getChange_task)
+      Returns:
+        - list of the tasks started
+    """
+    if change_reference == False and any(t.endswith('_change') for t in types):
+      raise ValueError('change products need a reference date range (change_reference)')
+
+    aois = [self.boundaries_path] if aois == False else aois
+    state_file = os.path.join(self.folder, 'monitor_state.json') if state_file == False else state_file
+    state = self.load_monitor_state(state_file)
+    now = datetime.now().timestamp()
+
+    # new acquisitions -> pending buckets
+    for aoi, collections in self.poll_acquisitions(aois, state, lookback_days=lookback_days).items():
+      for collection, times in collections.items():
+        if len(times) == 0:
+          continue
+        mark_key = aoi + '|' + collection
+        state['high_water_marks'][mark_key] = max(max(times), state['high_water_marks'].get(mark_key, 0))
+        product_group = 'cloud' if collection == 'COPERNICUS/S2_CLOUD_PROBABILITY' else 'image'
+        group_key = aoi + '|' + product_group
+        pending = state['pending'].setdefault(group_key, {})
+        submitted = [key.split('|')[2] for key in state['submitted'] if key.startswith(group_key + '|')]
+        for day in sorted({datetime.fromtimestamp(t / 1000, tz=timezone.utc).strftime("%Y-%m-%d") for t in times}):
+          # the acquisitions of the same next_date bucket are coalesced
+          bucket = [b for b in list(pending) + submitted if b <= day < self.add_days(b, next_date)]
+          bucket = bucket[0] if bucket else day
+          if bucket not in submitted:
+            pending.setdefault(bucket, now)
+
+        # the buckets older than the lookback of the high-water mark can not be found again
+        mark_day = datetime.fromtimestamp(state['high_water_marks'][mark_key] / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+        oldest = self.add_days(mark_day, -(lookback_days + next_date + 1))
+        for key in [key for key in state['submitted'] if key.startswith(group_key + '|') and key.split('|')[2] < oldest]:
+          del state['submitted'][key]
+
+    # settled buckets -> queue
+    for group_key, pending in state['pending'].items():
+      aoi, product_group = group_key.split('|')
+      for bucket, first_seen in list(pending.items()):
+        if now - first_seen >= settle_minutes * 60:
+          state['queue'].append({'aoi': aoi, 'group': product_group, 'bucket': bucket})
+          state['submitted'][group_key + '|' + bucket] = None
+          del pending[bucket]
+
+    # submit the queue with a concurrency cap
+    running = 0
+    ids = [task_id for task_id in state['submitted'].values() if task_id]
+    if ids:
+      states = {task.id: task.state for task in self.api.batch.Task.list() if task.id in ids}
+      running = len([task_id for task_id in ids if states.get(task_id) in ['READY', 'RUNNING']])
+
+    self.save_monitor_state(state, state_file)
+    started = []
+    retry = []
+    while state['queue'] and running < max_running:
+      item = state['queue'].pop(0)
+      try:
+        task = self.getMonitor_task(item, types, next_date=next_date, mask=mask, mask_water=mask_water, change_reference=change_reference,
+                                    change_threshold=change_threshold, change_uint8=change_uint8)
+        if task is not None:
+          task.start()
+          running += 1
+          started.append(task)
+        state['submitted'][item['aoi'] + '|' + item['group'] + '|' + item['bucket']] = getattr(task, 'id', None)
+      except Exception as error:
+        item['attempts'] = item.get('attempts', 0) + 1
+        item['error'] = str(error)
+        print('monitor', item['aoi'], item['group'], item['bucket'], 'failed', error)
+        if item['attempts'] < max_attempts:
+          retry.append(item)
+        else:
+          state['failed'].append(item)
+      # saved after every item, so that a task started is never submitted again
+      self.save_monitor_state(dict(state, queue=state['queue'] + retry), state_file)
+    state['queue'] += retry
+    self.save_monitor_state(state, state_file)
+    return started
+
+
+  def getMonitor_task(self, item, types, next_date=1, mask=False, mask_water=False, change_reference=False, change_threshold=False,
+                      change_uint8=False):
+    """
+      Description:
+        task of a bucket queued by monitor_once
+      Args:
+        @ self:
+        @ item : queued product {aoi, group, bucket}
+        @ types, next_date, mask, mask_water, change_reference, change_threshold, change_uint8 : see monitor_once
+      Returns:
+        - a task (None when types has no product for the group)
+    """
+    aoi = download_s2_images(self.api, item['aoi'], self.start_date, self.end_date, self.cloud_percentage,
+                             function=self.function, folder=self.folder, result_cache=self.result_cache)
+    start_date = item['bucket']
+    end_date = aoi.add_days(start_date, next_date)
+    image_name = start_date + '_' + start_date + 'plus' + str(next_date)
+
+    if item['group'] == 'cloud':
+      if 'cloud' not in types:
+        return None
+      cloud_img = self.api.ImageCollection('COPERNICUS/S2_CLOUD_PROBABILITY').filterBounds(aoi.getGeometry()).filterDate(start_date, end_date)
+      cloud_img = cloud_img.mosaic() if self.function == 'mosaic' else cloud_img.median()
+      return aoi.getS2cloudless_task('cloud_' + image_name, cloud_img)
+
+    if mask == False:
+      window = aoi.setImage(start_date, end_date)
+    else:
+      window = aoi.setMask_images(start_date, end_date)
+    single_img = window.mosaic() if self.function == 'mosaic' else window.median()
+    if mask_water != False:
+      single_img = aoi.mask_permanent_water(single_img, date_range_=[mask_water[0], mask_water[1]])
+    return aoi.call_task(types, image_name, single_img, change_reference=change_reference, change_threshold=change_threshold,
+                         change_uint8=change_uint8)
+
+
+  def monitor(self, types=['mndwi'], aois=False, state_file=False, poll_minutes=15, next_date=1, mask=False, mask_water=False,
+              max_running=5, settle_minutes=30, lookback_days=3, max_attempts=3, change_reference=False, change_threshold=False,
+              change_uint8=False):
+    """
+      Description:
+        long-running scheduler for near-real-time exports : monitor_once every poll_minutes. The
+        high-water marks are kept in the state file, so a restarted scheduler only emits the new products
+      Args:
+        @ self:
+        @ poll_minutes : time between 2 polls
+        @ others : see monitor_once
+      Returns:
+    """
+    import time
+
+    if change_reference == False and any(t.endswith('_change') for t in types):
+      raise ValueError('change products need a reference date range (change_reference)')
+
+    while True:
+      try:
+        started = self.monitor_once(types, aois=aois, state_file=state_file, next_date=next_date, mask=mask, mask_water=mask_water,
+                                    max_running=max_running, settle_minutes=settle_minutes, lookback_days=lookback_days,
+                                    max_attempts=max_attempts, change_reference=change_reference, change_threshold=change_threshold,
+                                    change_uint8=change_uint8)
+        print(datetime.now().strftime("%Y-%m-%d %H:%M"), 'started', len(started), 'tasks')
+      except Exception as error:
+        print('monitor error', error)
+      time.sleep(poll_minutes * 60)
+
+
+#========================================================================================
+#==========================  CACHED TASK
+#========================================================================================
+class cached_task(object):
+  """
+    Description:
+      stands for a task whose output already exists, or is being exported by a task in flight (see
+      download_s2_images.getTask). It has the interface of a GEE task, but start() does not submit anything
+  """
+
+  def __init__(self, key, entry):
+    self.key = key
+    self.entry = entry
+    self.id = entry.get('task_id')
+    self.config = {'description': entry['description']}
+    self.state = entry.get('state', 'COMPLETED')
+
+  def start(self):
+    return None
+
+  def status(self):
+    return {'state': self.state, 'id': self.id, 'description': self.entry['description'], 'location': self.entry['location']}
+
+  def active(self):
+    return self.state in ['UNSUBMITTED', 'READY', 'RUNNING']
+
+
+class result_task(object):
+  """
+    Description:
+      a GEE task of the result cache (see download_s2_images.getTask). The output is registered in the
+      cache, with the id of the task, only once start() succeeded. The other attributes are the ones of
+      the GEE task
+  """
+
+  def __init__(self, generate_im, key, task, entry):
+    self.generate_im = generate_im
+    self.key = key
+    self.task = task
+    self.entry = entry
+
+  def start(self):
+    result = self.task.start()
+    self.generate_im.register_result(self.key, dict(self.entry, task_id=self.task.id))
+    return result
+
+  def __getattr__(self, name):
+    if name == 'task':
+      raise AttributeError(name)
+    return getattr(self.task, name)
+
+
+class _file_lock(object):
+  """
+    Description:
+      exclusive lock on a file, shared by the processes of the machine (and of the machines of a
+      network file system that supports the locks)
+  """
+
+  def __init__(self, lock_file):
+    self.lock_file = lock_file
+
+  def __enter__(self):
+    self.f = open(self.lock_file, 'a')
+    try:
+      import fcntl
+      fcntl.flock(self.f, fcntl.LOCK_EX)
+    except ImportError:
+      import msvcrt
+      msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+    return self
+
+  def __exit__(self, *args):
+    try:
+      import fcntl
+      fcntl.flock(self.f, fcntl.LOCK_UN)
+    except ImportError:
+      import msvcrt
+      msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+    self.f.close()
+    return False
+
+
+#========================================================================================
+#==========================  LOCAL POST-PROCESSING (PROCESS POOL WORKERS)
+#========================================================================================
+# The workers are module level functions so that they can be sent to the processes of the pool.
+# Every worker opens the files itself and reads only its block windows.
+
+def _read_block(index_file, window):
+  """
+    Description:
+      read a block of an index file, the nodata and NaN pixels are masked
+  """
+  import numpy as np
+  import rasterio
+
+  with rasterio.open(index_file) as src:
+    block = src.read(1, window=window, masked=True).astype('float32')
+  return np.ma.masked_invalid(block)
+
+
+def _histogram_worker(args):
+  """
+    Description:
+      histogram of the index values of a list of block windows (first pass of the Otsu threshold)
+  """
+  import numpy as np
+
+  index_file, windows, bins = args
+  histogram = np.zeros(bins, dtype='int64')
+  for window in windows:
+    block = _read_block(index_file, window)
+    histogram += np.histogram(block.compressed(), bins=bins, range=(-1, 1))[0]
+  return histogram
+
+
+def _otsu_threshold(histogram):
+  """
+    Description:
+      Otsu threshold of an index histogram on [-1, 1]
+  """
+  import numpy as np
+
+  edges = np.linspace(-1, 1, len(histogram) + 1)
+  centers = (edges[:-1] + edges[1:]) / 2
+  weight1 = np.cumsum(histogram)
+  weight2 = weight1[-1] - weight1
+  sum1 = np.cumsum(histogram * centers)
+  mean1 = sum1 / np.maximum(weight1, 1)
+  mean2 = (sum1[-1] - sum1) / np.maximum(weight2, 1)
+  between = weight1 * weight2 * (mean1 - mean2) ** 2
+  # the pixels of the bins up to the best split are below the threshold
+  return float(edges[np.argmax(between) + 1])
+
+
+def _water_worker(args):
+  """
+    Description:
+      water mask of a block window (255 : nodata) and water area (m2) of the zones in the window
+  """
+  import numpy as np
+  import rasterio
+  from rasterio import features, windows as rio_windows
+  from rasterio.vrt import WarpedVRT
+
+  index_file, window, threshold, permanent_water, zones = args
+  block = _read_block(index_file, window)
+  water = block.filled(threshold) > threshold
+
+  with rasterio.open(index_file) as src:
+    transform = rio_windows.transform(window, src.transform)
+    geographic = src.crs is not None and src.crs.is_geographic
+    if permanent_water != False:
+      # the permanent water raster is warped on the grid of the index file
+      with rasterio.open(permanent_water) as pw, WarpedVRT(pw, crs=src.crs, transform=src.transform, width=src.width, height=src.height) as vrt:
+        water &= ~(vrt.read(1, window=window) > 0)
+
+  # area of the pixels of every row (degrees are converted on the sphere for geographic files)
+  pixel_area = abs(transform.a * transform.e)
+  if geographic:
+    lat = transform.f + (np.arange(block.shape[0]) + 0.5) * transform.e
+    pixel_area = pixel_area * 111320.0 * 110540.0 * np.cos(np.radians(lat))[:, None]
+  area = np.broadcast_to(pixel_area, block.shape) * (water & ~np.ma.getmaskarray(block))
+
+  areas = {}
+  if zones:
+    zone_ids = [zone_id for zone_id, _ in zones]
+    labels = features.rasterize(((geom, i + 1) for i, (_, geom) in enumerate(zones)), out_shape=block.shape, transform=transform, fill=0, dtype='int32')
+    sums = np.bincount(labels.ravel(), weights=area.ravel(), minlength=len(zones) + 1)
+    areas = {zone_id: float(sums[i + 1]) for i, zone_id in enumerate(zone_ids)}
+  else:
+    areas = {'all': float(area.sum())}
+
+  mask = np.where(np.ma.getmaskarray(block), 255, water).astype('uint8')
+  return window, mask, areas
+
+
+def postprocess_file(index_file, output_file, threshold='otsu', permanent_water=False, zones=False, zone_field=False,
+                     max_workers=None, bins=512, block_size=512):
+  """
+    Description:
+      threshold an index GeoTIFF into a water mask (Cloud Optimized GeoTIFF, 0 / 1, 255 : nodata) and
+      aggregate the water area per polygon. The file is streamed by its internal block windows, the
+      blocks are processed in a process pool and written as they come back
+    Args:
+      @ index_file : downloaded index GeoTIFF
+      @ output_file : output COG
+      @ threshold : fixed threshold of the index, or 'otsu' (computed from a streamed histogram)
+      @ permanent_water : raster of the permanent water (pixels > 0 are removed from the water mask)
+      @ zones : vector file of the polygons, False for the whole scene
+      @ zone_field : attribute of zones used as zone id (default : row index)
+      @ max_workers : number of processes (default : number of cores)
+      @ bins : number of bins of the Otsu histogram
+      @ block_size : block size of the output (and rows read at once from a striped file)
+    Returns:
+      - dictionary with the threshold, the water area (m2) of every zone and the output file
+  """
+  import rasterio
+  from rasterio import windows as rio_windows
+  from rasterio.shutil import copy as rio_copy
+  from concurrent.futures import ProcessPoolExecutor
+
+  max_workers = max_workers or os.cpu_count() or 1
+  with rasterio.open(index_file) as src:
+    profile = src.profile.copy()
+    if profile.get('tiled'):
+      block_windows = [window for _, window in src.block_windows(1)]
+    else:
+      # striped files (gdal_merge of the split exports, ...) are read by groups of block_size rows
+      block_windows = [rio_windows.Window(0, row, src.width, min(block_size, src.height - row)) for row in range(0, src.height, block_size)]
+    crs = src.crs
+    transform = src.transform
+
+  zone_list = []
+  if zones != False:
+    import geopandas as gpd
+    from shapely.geometry import box
+    zones_df = gpd.read_file(zones)
+    if crs is not None:
+      zones_df = zones_df.to_crs(crs)
+    ids = zones_df[zone_field] if zone_field != False else zones_df.index
+    zone_list = list(zip(ids.tolist() if hasattr(ids, 'tolist') else list(ids), zones_df.geometry))
+
+  with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    if threshold == 'otsu':
+      chunks = [block_windows[i::max_workers] for i in range(max_workers)]
+      histogram = sum(executor.map(_histogram_worker, [(index_file, chunk, bins) for chunk in chunks]))
+      threshold = _otsu_threshold(histogram)
+
+    def argsDriver(window):
+      bounds = rio_windows.bounds(window, transform)
+      # only the zones that intersect the block are sent to the worker
+      window_zones = [(zone_id, geom) for zone_id, geom in zone_list if geom.intersects(box(*bounds))] if zone_list else []
+      return (index_file, window, threshold, permanent_water, window_zones)
+
+    areas = {zone_id: 0.0 for zone_id, _ in zone_list} if zone_list else {'all': 0.0}
+    # the block size of the source is not kept (the blocks of a tiled GeoTIFF must be multiples of 16)
+    profile.update(driver='GTiff', dtype='uint8', count=1, nodata=255, tiled=True, blockxsize=block_size, blockysize=block_size, compress='deflate')
+    tmp_file = output_file + '.tmp.tif'
+    with rasterio.open(tmp_file, 'w', **profile) as dst:
+      # the blocks are submitted by batches so that only a few blocks are in memory at the same time
+      batch = max_workers * 4
+      for first in range(0, len(block_windows), batch):
+        for window, mask, block_areas in executor.map(_water_worker, [argsDriver(w) for w in block_windows[first:first + batch]]):
+          dst.write(mask, 1, window=window)
+          for zone_id, area in block_areas.items():
+            areas[zone_id] = areas.get(zone_id, 0.0) + area
+
+  rio_copy(tmp_file, output_file, driver='COG', compress='deflate')
+  os.remove(tmp_file)
+  return {'threshold': threshold, 'areas': areas, 'output': output_file}
+
+
+#========================================================================================
+#==========================  JOB SPEC CLI AND SHARDED EXECUTION
+#========================================================================================
+# A job spec (YAML or JSON) describes a whole run :
+#   aois : [PATH_TO_ASSET, ...]          start_date, end_date : '2022-01-01'
+#   types : [mndwi]                      cloud_percentage : 100      function : mosaic
+#   folder : earthengine                 mask : false                mask_water : false
+#   next_date : 1                        interval : false (or the interval of getAll_images_by_interval)
+#   shard_days : 30                      project : GEE cloud project (optional)
+#   window_anchor : date on which the shards and the intervals are aligned (default : start_date)
+# The job is split in shards (AOI x date window) stored in a SQLite work queue. Workers (processes of
+# this machine, or of other machines sharing the queue file) lease the shards, and the shards of a
+# crashed worker are leased again by the others when their lease expires.
+
+def load_job_spec(job_file):
+  """
+    Description:
+      read a job spec (YAML or JSON)
+  """
+  import json
+
+  with open(job_file) as f:
+    if job_file.endswith('.json'):
+      return json.load(f)
+    import yaml
+    return yaml.safe_load(f)
+
+
+def shard_job(spec):
+  """
+    Description:
+      split a job spec in shards (AOI x date window). In the interval mode the shards are multiples of
+      the interval from window_anchor (default : start_date), and every shard aligns its windows on
+      window_anchor, so that the intervals are the same as the ones of a single run with this anchor.
+      In the date mode the collection of a shard goes next_date - 1 days further (up to the end of the
+      job) and only the buckets that start in the shard are exported (bucket_end), so that the next_date
+      buckets are the same as the ones of a single run
+    Returns:
+      - list of (shard id, shard spec)
+  """
+  shard_days = int(spec.get('shard_days', 30))
+  if spec.get('interval', False):
+    shard_days = max(1, shard_days // int(spec['interval'])) * int(spec['interval'])
+
+  anchor = spec.get('window_anchor', spec['start_date'])
+  windows = download_s2_images.plan_windows(spec['start_date'], spec['end_date'], length=shard_days, anchor=anchor)
+
+  next_date = int(spec.get('next_date', 1))
+  shards = []
+  for aoi in spec['aois']:
+    for start_date, end_date in windows:
+      shard = dict(spec, aoi=aoi, start_date=start_date, end_date=end_date, window_anchor=anchor)
+      if not spec.get('interval', False):
+        shard['end_date'] = min(download_s2_images.add_days(end_date, next_date - 1), spec['end_date'])
+        shard['bucket_end'] = end_date
+      del shard['aois']
+      shards.append((aoi + '|' + start_date + '|' + end_date, shard))
+  return shards
+
+
+class work_queue(object):
+  """
+    Description:
+      SQLite work queue of shards with leases. The queue file can be shared between several machines
+  """
+
+  def __init__(self, queue_file, lease_minutes=30, max_attempts=3):
+    import sqlite3
+
+    self.queue_file = queue_file
+    self.lease_seconds = lease_minutes * 60
+    self.max_attempts = max_attempts
+    self.connection = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+    self.connection.execute("""CREATE TABLE IF NOT EXISTS shards (id TEXT PRIMARY KEY, spec TEXT, state TEXT DEFAULT 'pending',
+                               owner TEXT, lease_until REAL DEFAULT 0, attempts INTEGER DEFAULT 0, result TEXT)""")
+
+  def submit(self, shards):
+    """
+      Description:
+        add shards to the queue (the shards already in the queue are kept as they are)
+    """
+    import json
+
+    self.connection.executemany("INSERT OR IGNORE INTO shards (id, spec) VALUES (?, ?)",
+                                [(shard_id, json.dumps(shard)) for shard_id, shard in shards])
+    return len(shards)
+
+  def lease(self, owner):
+    """
+      Description:
+        lease the next pending shard, or a running shard whose lease expired (crashed worker)
+      Returns:
+        - (shard id, shard spec), None when there is nothing left to do
+    """
+    import json
+
+    now = datetime.now().timestamp()
+    self.connection.execute('BEGIN IMMEDIATE')
+    try:
+      # the shards of a crashed worker that reached max_attempts are failed
+      self.connection.execute("UPDATE shards SET state = 'failed' WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                              (now, self.max_attempts))
+      row = self.connection.execute("""SELECT id, spec FROM shards WHERE attempts < ? AND
+                                       (state = 'pending' OR (state = 'running' AND lease_until < ?)) LIMIT 1""",
+                                    (self.max_attempts, now)).fetchone()
+      if row is not None:
+        self.connection.execute("UPDATE shards SET state = 'running', owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                                (owner, now + self.lease_seconds, row[0]))
+      self.connection.execute('COMMIT')
+    except Exception:
+      self.connection.execute('ROLLBACK')
+      raise
+    return None if row is None else (row[0], json.loads(row[1]))
+
+  def renew(self, shard_id, owner):
+    """
+      Description:
+        extend the lease of a shard that is still processed
+    """
+    self.connection.execute("UPDATE shards SET lease_until = ? WHERE id = ? AND owner = ?",
+                            (datetime.now().timestamp() + self.lease_seconds, shard_id, owner))
+
+  def finish(self, shard_id, owner, result, failed=False):
+    """
+      Description:
+        mark a shard as done, or put it back in the queue when it failed (failed after max_attempts)
+    """
+    if failed:
+      self.connection.execute("""UPDATE shards SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, result = ?,
+                                 lease_until = 0 WHERE id = ? AND owner = ?""", (self.max_attempts, str(result), shard_id, owner))
+    else:
+      self.connection.execute("UPDATE shards SET state = 'done', result = ?, lease_until = 0 WHERE id = ? AND owner = ?",
+                              (str(result), shard_id, owner))
+
+  def status(self):
+    """
+      Description:
+        number of shards per state
+    """
+    return dict(self.connection.execute("SELECT state, COUNT(*) FROM shards GROUP BY state").fetchall())
+
+
+def run_shard(api, shard):
+  """
+    Description:
+      create and start the tasks of a shard
+    Returns:
+      - number of tasks started
+  """
+  generate_im = download_s2_images(api, shard['aoi'], shard['start_date'], shard['end_date'], shard.get('cloud_percentage', 100),
+                                   function=shard.get('function', 'mosaic'), folder=shard.get('folder', 'earthengine'))
+  if shard.get('interval', False):
+    tasks = generate_im.getAll_images_by_interval(shard['types'], mask=shard.get('mask', False), mask_water=shard.get('mask_water', False),
+                                                  interval=int(shard['interval']), window_anchor=shard.get('window_anchor', False))
+  else:
+    tasks = generate_im.getAll_images(shard['types'], mask=shard.get('mask', False), mask_water=shard.get('mask_water', False),
+                                      next_date=int(shard.get('next_date', 1)), bucket_end=shard.get('bucket_end', False))
+  for task in tasks:
+    task.start()
+  return len(tasks)
+
+
+def run_worker(queue_file, project=None, lease_minutes=30, poll_seconds=60):
+  """
+    Description:
+      worker loop : initialize its own GEE session, then lease and run shards until the queue is empty.
+      The lease is renewed while a shard runs. While shards of other workers are still running, the
+      worker waits (polling every poll_seconds), so that the shard of a crashed worker is taken again
+      when its lease expires
+  """
+  import socket
+  import threading
+  import time
+  import ee
+
+  if project:
+    ee.Initialize(project=project)
+  else:
+    ee.Initialize()
+
+  owner = socket.gethostname() + ':' + str(os.getpid())
+  queue = work_queue(queue_file, lease_minutes=lease_minutes)
+  done = 0
+  while True:
+    leased = queue.lease(owner)
+    if leased is None:
+      if queue.status().get('running', 0) == 0:
+        return done
+      time.sleep(poll_seconds)
+      continue
+    shard_id, shard = leased
+
+    stop = threading.Event()
+    def renewDriver():
+      # a connection per thread, sqlite connections can not be shared between threads
+      renew_queue = work_queue(queue_file, lease_minutes=lease_minutes)
+      while not stop.wait(lease_minutes * 60 / 3):
+        renew_queue.renew(shard_id, owner)
+    renewer = threading.Thread(target=renewDriver, daemon=True)
+    renewer.start()
+
+    try:
+      n_tasks = run_shard(ee, shard)
+      queue.finish(shard_id, owner, n_tasks)
+      print(owner, 'shard', shard_id, n_tasks, 'tasks')
+      done += 1
+    except Exception as error:
+      queue.finish(shard_id, owner, error, failed=True)
+      print(owner, 'shard', shard_id, 'failed', error)
+    finally:
+      stop.set()
+      renewer.join()
+
+
+def main(argv=None):
+  """
+    Description:
+      command line interface
+        python download_s2_GEE.py submit job.yaml --queue queue.sqlite
+        python download_s2_GEE.py work --queue queue.sqlite --workers 4 [--project PROJECT]
+        python download_s2_GEE.py run job.yaml --workers 4          (submit + work on this machine)
+        python download_s2_GEE.py status --queue queue.sqlite
+  """
+  import argparse
+  from multiprocessing import Process
+
+  parser = argparse.ArgumentParser(description='Download sentinel-2 images on GEE from a job spec')
+  parser.add_argument('command', choices=['submit', 'work', 'run', 'status'])
+  parser.add_argument('job', nargs='?', help='job spec (YAML or JSON)')
+  parser.add_argument('--queue', default=False, help='SQLite work queue (default : folder/queue.sqlite)')
+  parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+  parser.add_argument('--project', default=None, help='GEE cloud project')
+  parser.add_argument('--lease-minutes', type=float, default=30)
+  args = parser.parse_args(argv)
+
+  spec = load_job_spec(args.job) if args.job else {}
+  queue_file = args.queue
+  if queue_file == False:
+    folder = spec.get('folder', 'earthengine')
+    if not os.path.exists(folder):
+      os.makedirs(folder)
+    queue_file = os.path.join(folder, 'queue.sqlite')
+  project = args.project or spec.get('project')
+
+  if args.command in ['submit', 'run']:
+    print('submitted', work_queue(queue_file).submit(shard_job(spec)), 'shards')
+
+  if args.command in ['work', 'run']:
+    workers = [Process(target=run_worker, args=(queue_file, project, args.lease_minutes)) for _ in range(args.workers)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+
+  print(work_queue(queue_file).status())
+
+
+if __name__ == '__main__':
+  main()
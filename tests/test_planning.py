@@ -0,0 +1,94 @@
+""" Tests of the local date window planning and export deduplication (no GEE session needed)
+
+  python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from download_s2_GEE import download_s2_images
+
+ACQUISITIONS = ['2022-01-02', '2022-01-07']
+
+
+def make_downloader(tmp_path):
+  return download_s2_images(None, 'PATH_TO_ASSET', '2022-01-01', '2022-01-20', 100, folder=str(tmp_path))
+
+
+#========================================================================================
+#==========================  plan_windows
+#========================================================================================
+def test_fixed_windows_end_excluded():
+  windows = download_s2_images.plan_windows('2022-01-01', '2022-01-31', length=5, anchor='2022-01-01')
+  assert windows[0] == ('2022-01-01', '2022-01-06')
+  assert windows[-1] == ('2022-01-26', '2022-01-31')
+  assert len(windows) == 6
+
+
+def test_windows_without_acquisition_are_dropped():
+  windows = download_s2_images.plan_windows('2022-01-01', '2022-01-31', length=5, acquisition_dates=['2022-01-03', '2022-01-30'],
+                                            anchor='2022-01-01')
+  # the acquisition of the last day of the range is kept
+  assert windows == [('2022-01-01', '2022-01-06'), ('2022-01-26', '2022-01-31')]
+
+
+def test_default_anchor_is_first_acquisition():
+  windows = download_s2_images.plan_windows('2022-01-01', '2022-01-31', length=5, acquisition_dates=['2022-01-03', '2022-01-30'])
+  assert windows == [('2022-01-03', '2022-01-08'), ('2022-01-28', '2022-01-31')]
+
+
+def test_sliding_windows():
+  windows = download_s2_images.plan_windows('2022-01-01', '2022-01-20', mode='sliding', length=10, step=5)
+  assert windows == [('2022-01-01', '2022-01-11'), ('2022-01-06', '2022-01-16'), ('2022-01-11', '2022-01-20'), ('2022-01-16', '2022-01-20')]
+
+
+def test_month_and_dekad_windows():
+  assert download_s2_images.plan_windows('2022-01-15', '2022-03-01', mode='month') == [('2022-01-15', '2022-02-01'), ('2022-02-01', '2022-03-01')]
+  assert download_s2_images.plan_windows('2022-02-01', '2022-03-01', mode='dekad') == [('2022-02-01', '2022-02-11'), ('2022-02-11', '2022-02-21'),
+                                                                                     ('2022-02-21', '2022-03-01')]
+
+
+def test_shards_of_a_run_have_the_windows_of_the_run():
+  run = download_s2_images.plan_windows('2022-01-01', '2022-02-28', length=5, anchor='2022-01-01')
+  shards = download_s2_images.plan_windows('2022-01-01', '2022-02-28', length=30, anchor='2022-01-01')
+  sharded = []
+  for start_date, end_date in shards:
+    sharded += download_s2_images.plan_windows(start_date, end_date, length=5, anchor='2022-01-01')
+  assert sharded == run
+
+
+#========================================================================================
+#==========================  dedupe_requests
+#========================================================================================
+def test_sliding_windows_with_the_same_acquisitions_are_collapsed(tmp_path):
+  generate_im = make_downloader(tmp_path)
+  windows = download_s2_images.plan_windows('2022-01-01', '2022-01-20', mode='sliding', length=10, step=5)
+  kept = generate_im.dedupe_windows(windows, ACQUISITIONS, 'source', 'transform', 'mndwi')
+  # [01-06, 01-16) only contains 01-07 : it is a different composite and is kept
+  assert kept == [('2022-01-01', '2022-01-11'), ('2022-01-06', '2022-01-16'), ('2022-01-11', '2022-01-20')]
+  assert generate_im.saved_exports == 1
+
+
+def test_exact_duplicates_are_removed(tmp_path):
+  generate_im = make_downloader(tmp_path)
+  request = {'start': '2022-01-02', 'end': '2022-01-05', 'source': 'source', 'transform': 'transform', 'product': 'mndwi'}
+  assert generate_im.dedupe_requests([dict(request), dict(request)], ACQUISITIONS) == [request]
+  assert generate_im.saved_exports == 1
+
+
+def test_overlapping_buckets_are_kept(tmp_path):
+  generate_im = make_downloader(tmp_path)
+  # next_date = 3 : the bucket of 01-02 contains 01-02 and 01-03, the one of 01-03 only 01-03
+  dates = ['2022-01-02', '2022-01-03']
+  requests = [{'start': d, 'end': download_s2_images.add_days(d, 3), 'source': 'source', 'transform': 'transform', 'product': 'mndwi'}
+              for d in dates]
+  assert generate_im.dedupe_requests(requests, dates) == requests
+  assert generate_im.saved_exports == 0
+
+
+def test_different_products_are_kept(tmp_path):
+  generate_im = make_downloader(tmp_path)
+  requests = [{'start': '2022-01-01', 'end': '2022-01-10', 'source': 'source', 'transform': 'transform', 'product': product}
+              for product in ['mndwi', 'ndvi']]
+  assert generate_im.dedupe_requests(requests, ACQUISITIONS) == requests